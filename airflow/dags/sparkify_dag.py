@@ -28,11 +28,16 @@ default_args = {
     }
 }
 
+# stage only new S3 objects via COPY manifests written to this prefix, e.g. s3://my-bucket/manifests
+manifest_prefix = Variable.get("s3_manifest_prefix", default_var=None)
+incremental = manifest_prefix is not None
+
 # define DAG
 with DAG(dag_id="sparkify_dag",
          description="Load and transform data from S3 into Redshift",
          default_args=default_args,
          schedule_interval="@hourly",
+         max_active_runs=1,
          template_searchpath=str(Path(__file__).parent.parent.joinpath("sql"))) as dag:
 
     # define tasks
@@ -51,7 +56,9 @@ with DAG(dag_id="sparkify_dag",
         s3_region="{{ params.s3_region }}",
         redshift_table="staging_events",
         json_path="{{ params.s3_json_path }}",
-        truncate=False
+        truncate=True,
+        incremental=incremental,
+        manifest_prefix=manifest_prefix
     )
 
     stage_songs_to_redshift = StageToRedshiftOperator(
@@ -62,60 +69,81 @@ with DAG(dag_id="sparkify_dag",
         s3_region="{{ params.s3_region }}",
         redshift_table="staging_songs",
         json_path="auto",
-        truncate=False
+        truncate=True,
+        incremental=incremental,
+        manifest_prefix=manifest_prefix
     )
 
     load_songplays_table = LoadFactOperator(
         task_id="load_songplay_fact_table",
-        fact_table="songplay",
+        fact_table="songplays",
         fact_cols="playid, start_time, userid, level, songid, artistid, sessionid, location, user_agent",
         sql="songplay_insert.sql",
-        truncate=False
+        truncate=False,
+        # staged new objects may contain events of any time, so they are merged by key instead of per hour
+        window_start=None if incremental else "{{ execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
+        window_end=None if incremental else "{{ next_execution_date.strftime('%Y-%m-%d %H:%M:%S') }}",
+        time_column="start_time",
+        key_column="playid" if incremental else None
     )
 
     load_user_dimension_table = LoadDimensionOperator(
         task_id='load_user_dim_table',
         dim_table="users",
-        dim_cols="userid, first_name, last_name, gender, 'level'",
+        dim_cols='userid, first_name, last_name, gender, "level"',
         sql="user_insert.sql",
-        truncate=False
+        mode="merge",
+        merge_keys=["userid"]
     )
 
     load_song_dimension_table = LoadDimensionOperator(
         task_id='load_song_dim_table',
         dim_table="songs",
-        dim_cols="songid, title, artistid, 'year', duration",
+        dim_cols='songid, title, artistid, "year", duration',
         sql="song_insert.sql",
-        truncate=False
+        mode="merge",
+        merge_keys=["songid"]
     )
 
     load_artist_dimension_table = LoadDimensionOperator(
         task_id='load_artist_dim_table',
         dim_table="artists",
-        dim_cols="artistid, name, location, latitude, longitude",
+        dim_cols="artistid, name, location, lattitude, longitude",
         sql="artist_insert.sql",
-        truncate=False
+        mode="merge",
+        merge_keys=["artistid"]
     )
 
     load_time_dimension_table = LoadDimensionOperator(
         task_id='load_time_dim_table',
         dim_table="time",
-        dim_cols="start_time, 'hour', 'day', week, 'month', 'year', weekday",
+        dim_cols='start_time, "hour", "day", week, "month", "year", weekday',
         sql="time_insert.sql",
-        truncate=False
+        mode="merge",
+        merge_keys=["start_time"]
     )
 
     run_quality_checks = DataQualityOperator(
         task_id='run_data_quality_checks',
-        check_tables=["songplay", "users", "songs", "artists", "time"],
-        check_sql="has_rows"
+        check_tables=["songplays", "users", "songs", "artists", "time"],
+        check_sql="has_rows",
+        checks=[
+            {"table": "songplays", "check": "null_count", "column": "start_time"},
+            {"table": "songplays", "check": "duplicate_count", "column": "playid"},
+            {"table": "users", "check": "null_count", "column": "userid"},
+            {"table": "users", "check": "duplicate_count", "column": "userid"},
+            {"table": "songs", "check": "duplicate_count", "column": "songid"},
+            {"table": "artists", "check": "duplicate_count", "column": "artistid"},
+            {"table": "time", "check": "duplicate_count", "column": "start_time"}
+        ]
     )
 
     end = DummyOperator(task_id='Stop_execution')
 
-    # define task dependencies
+    # define task dependencies: staging tables only hold the data of the current run, songplays look up songs and
+    # artists in the dimension tables
     staging_tasks = [stage_events_to_redshift, stage_songs_to_redshift]
     load_dim_tables = [load_song_dimension_table, load_artist_dimension_table, load_user_dimension_table,
                        load_time_dimension_table]
 
-    start >> create_tables >> staging_tasks >> load_songplays_table >> load_dim_tables >> run_quality_checks >> end
+    start >> create_tables >> staging_tasks >> load_dim_tables >> load_songplays_table >> run_quality_checks >> end
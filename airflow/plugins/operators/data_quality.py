@@ -1,7 +1,9 @@
+import time
 import logging
+import operator
+from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
-from airflow.operators.check_operator import CheckOperator
 
 
 class DataQualityOperator(BaseOperator):
@@ -11,16 +13,48 @@ class DataQualityOperator(BaseOperator):
 
     ui_color = '#89DA59'
 
+    # SQL expression computing the result of each kind of check
+    check_expressions = {
+        "row_count": "COUNT(*)",
+        "null_count": "COUNT(*) - COUNT({column})",
+        "duplicate_count": "COUNT({column}) - COUNT(DISTINCT {column})"
+    }
+
+    # expectation of each kind of check if none is declared
+    default_expectations = {
+        "row_count": (">", 0),
+        "null_count": ("==", 0),
+        "duplicate_count": ("==", 0)
+    }
+
+    operators = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le
+    }
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id: str,
                  check_tables: list,
-                 check_sql: str,
+                 check_sql: str = "has_rows",
+                 checks: list = None,
+                 batched: bool = True,
                  *args, **kwargs):
         """
         :param redshift_conn_id: Connection to Redshift database
         :param check_tables: List of Redshift tables to run data quality checks against
-        :param check_sql: Custom SQL statement specifying data quality check (use "has_rows" to use built-in check)
+        :param check_sql: Custom SQL statement specifying data quality check (use "has_rows" to use built-in check),
+        fails if any value of its first row is false, zero or NULL
+        :param checks: Additional checks as dictionaries with keys table, check (row_count, null_count or
+        duplicate_count), column (except for row_count) and optionally op (e.g. "==" or ">") and expected, e.g.
+        {"table": "users", "check": "null_count", "column": "userid"}. Without op and expected, row counts have to be
+        greater than 0 and null and duplicate counts have to be 0
+        :param batched: If True, run all checks in a single UNION ALL query, otherwise run one query per check to
+        measure the duration of each check
         :param args: Additional arguments
         :param kwargs: Additional keyword arguments
         """
@@ -29,20 +63,96 @@ class DataQualityOperator(BaseOperator):
         self.redshift_conn_id = redshift_conn_id
         self.check_tables = check_tables
         self.check_sql = check_sql
+        self.checks = checks or []
+        self.batched = batched
+
+        for check in self.checks:
+            if check["check"] not in self.check_expressions:
+                raise ValueError(f"Unknown check {check['check']}, use one of {', '.join(self.check_expressions)}")
+            if check["check"] != "row_count" and not check.get("column"):
+                raise ValueError(f"Check {check['check']} of table {check['table']} requires a column")
+            if check.get("op", "==") not in self.operators:
+                raise ValueError(f"Unknown operator {check['op']}, use one of {', '.join(self.operators)}")
+
+    def get_checks(self) -> list:
+        """
+        Return all checks to run, i.e. a row count check per table of check_tables (if check_sql is "has_rows")
+        followed by the declared checks, each with op and expected filled in.
+        :return: List of dictionaries
+        """
+        checks = [{"table": table, "check": "row_count"} for table in self.check_tables] \
+            if self.check_sql == "has_rows" else []
+
+        result = []
+        for check in checks + self.checks:
+            op, expected = self.default_expectations[check["check"]]
+            result.append(dict({"column": None, "op": op, "expected": expected}, **check))
+
+        return result
+
+    def check_query(self, check_id: int, check: dict) -> str:
+        """
+        Build the query computing the result of a check.
+        :param check_id: Index of the check, returned as first column
+        :param check: Check as returned by get_checks
+        :return: SQL statement
+        """
+        expression = self.check_expressions[check["check"]].format(column=check["column"])
+        return f"SELECT {check_id} AS check_id, CAST({expression} AS BIGINT) AS result FROM {check['table']}"
+
+    def describe(self, check: dict) -> str:
+        """
+        Describe a check, e.g. users.userid null_count.
+        :param check: Check as returned by get_checks
+        :return: Description
+        """
+        column = f".{check['column']}" if check["column"] else ""
+        return f"{check['table']}{column} {check['check']}"
 
     def execute(self, context):
 
-        # run quality checks
-        for table in self.check_tables:
+        # connect to redshift
+        redshift_hook = PostgresHook(self.redshift_conn_id)
+        checks = self.get_checks()
+        results = {}
+
+        if self.batched and checks:
+            # run all checks in one round trip
+            logging.info(f"Running {len(checks)} data quality checks in one query")
+            start = time.perf_counter()
+            records = redshift_hook.get_records("\nUNION ALL\n".join(
+                self.check_query(check_id, check) for check_id, check in enumerate(checks)))
+            logging.info(f"Ran {len(checks)} data quality checks in {time.perf_counter() - start:.2f}s")
+            results = {check_id: result for check_id, result in records}
+        else:
+            for check_id, check in enumerate(checks):
+                start = time.perf_counter()
+                results[check_id] = redshift_hook.get_first(self.check_query(check_id, check))[1]
+                logging.info(f"Ran data quality check {self.describe(check)} in {time.perf_counter() - start:.2f}s")
+
+        # compare results to expectations
+        report, failed = [], 0
+        for check_id, check in enumerate(checks):
+            result = results.get(check_id)
+            passed = result is not None and self.operators[check["op"]](result, check["expected"])
+            failed += not passed
+            report.append(f"{'PASSED' if passed else 'FAILED'} {self.describe(check)}: {result} "
+                          f"(expected {check['op']} {check['expected']})")
+
+        # run custom quality check
+        if self.check_sql != "has_rows":
+            logging.info("Running data quality check")
+            start = time.perf_counter()
+            record = redshift_hook.get_first(self.check_sql)
+            passed = bool(record) and all(record)
+            failed += not passed
+            report.append(f"{'PASSED' if passed else 'FAILED'} custom check: {record} "
+                          f"({time.perf_counter() - start:.2f}s)")
 
-            # run built-in quality checks
-            if self.check_sql == "has_rows":
-                logging.info(f"Running data quality check for table: {table}")
+        for line in report:
+            logging.info(line)
 
-                # check if data has been loaded into dimensions tables
-                CheckOperator(f"SELECT COUNT(*) FROM {table}", conn_id=self.redshift_conn_id)
+        if failed:
+            raise ValueError(f"{failed} of {len(report)} data quality checks failed:\n" + "\n".join(report))
 
-            # run custom quality check
-            else:
-                logging.info("Running data quality check")
-                CheckOperator(self.check_sql, conn_id=self.redshift_conn_id)
+        logging.info(f"All {len(report)} data quality checks passed")
@@ -10,6 +10,9 @@ class LoadDimensionOperator(BaseOperator):
     """
 
     ui_color = '#80BD9E'
+    template_fields = ("sql",)
+    template_ext = (".sql",)
+    modes = ("append", "truncate", "merge")
 
     @apply_defaults
     def __init__(self,
@@ -17,14 +20,19 @@ class LoadDimensionOperator(BaseOperator):
                  dim_table: str,
                  dim_cols: str,
                  sql: str,
-                 truncate: bool,
+                 truncate: bool = False,
+                 mode: str = None,
+                 merge_keys: list = None,
                  *args, **kwargs):
         """
         :param redshift_conn_id: Connection to Redshift database
         :param dim_table: Name of dimension table
         :param dim_cols: List of column names of dimension table as string
         :param sql: SQL statement used to select data that is inserted into dimension table
-        :param truncate: If True, clear dimension table before inserting new data
+        :param truncate: If True, clear dimension table before inserting new data (same as mode="truncate")
+        :param mode: One of "append" (insert selected rows), "truncate" (clear table first) or "merge" (replace rows
+        with the same merge_keys), defaults to "truncate" if truncate is True and to "append" otherwise
+        :param merge_keys: Columns identifying a row of the dimension table, required for mode="merge"
         :param args: Additional arguments
         :param kwargs: Additional keyword arguments
         """
@@ -34,7 +42,49 @@ class LoadDimensionOperator(BaseOperator):
         self.dim_table = dim_table
         self.dim_cols = dim_cols
         self.sql = sql
-        self.truncate = truncate
+        self.mode = mode or ("truncate" if truncate else "append")
+        self.merge_keys = merge_keys or []
+
+        if self.mode not in self.modes:
+            raise ValueError(f"Unknown mode {self.mode}, use one of {', '.join(self.modes)}")
+        if self.mode == "merge" and not self.merge_keys:
+            raise ValueError("merge_keys are required for mode merge")
+
+    def get_columns(self, redshift_hook: PostgresHook) -> list:
+        """
+        Look up the columns of the dimension table in their order.
+        :param redshift_hook: Hook to Redshift database
+        :return: List of column names
+        """
+        schema, _, table = self.dim_table.rpartition(".")
+        records = redshift_hook.get_records(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s "
+            "ORDER BY ordinal_position", parameters=(schema or "public", table))
+        return [record[0] for record in records]
+
+    def merge_sql(self, columns: list) -> list:
+        """
+        Build the statements of a Redshift-style upsert: selected rows are loaded into a temporary table, rows with
+        the same merge_keys are deleted from the dimension table and the new rows are inserted, keeping one row per key.
+        Which of several selected rows with the same key is kept is arbitrary, so sql should select one row per key,
+        e.g. the latest one (c.f. user_insert.sql).
+        :param columns: Columns of the dimension table, c.f. get_columns
+        :return: List of SQL statements
+        """
+        stage = f"{self.dim_table.rpartition('.')[2]}_merge"
+        cols = ", ".join(f'"{col}"' for col in columns)
+        keys = ", ".join(f'"{key}"' for key in self.merge_keys)
+        match = " AND ".join(f'{self.dim_table}."{key}" = {stage}."{key}"' for key in self.merge_keys)
+
+        return [
+            f"CREATE TEMP TABLE {stage} (LIKE {self.dim_table})",
+            f"INSERT INTO {stage} ({self.dim_cols}) {self.sql}",
+            f"DELETE FROM {self.dim_table} USING {stage} WHERE {match}",
+            f"INSERT INTO {self.dim_table} ({cols}) SELECT {cols} FROM ("
+            f"SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {keys}) AS merge_row FROM {stage}"
+            f") AS deduplicated WHERE merge_row = 1",
+            f"DROP TABLE {stage}"
+        ]
 
     def execute(self, context):
 
@@ -42,10 +92,16 @@ class LoadDimensionOperator(BaseOperator):
         logging.debug("Connecting to Redshift")
         redshift_hook = PostgresHook(self.redshift_conn_id)
 
-        # clear fact table if desired
-        if self.truncate:
+        # merge data from staging into dimension table in one transaction
+        if self.mode == "merge":
+            logging.info(f"Merging data into dimension table {self.dim_table} on {', '.join(self.merge_keys)}")
+            redshift_hook.run(self.merge_sql(self.get_columns(redshift_hook)))
+            return
+
+        # clear dimension table if desired
+        if self.mode == "truncate":
             redshift_hook.run(f"TRUNCATE {self.dim_table}")
 
-        # load data from staging into fact table
+        # load data from staging into dimension table
         logging.info(f"Loading data into dimension table {self.dim_table}")
         redshift_hook.run(f"INSERT INTO {self.dim_table} ({self.dim_cols}) {self.sql}")
@@ -10,6 +10,8 @@ class LoadFactOperator(BaseOperator):
     """
 
     ui_color = '#F98866'
+    template_fields = ("sql", "window_start", "window_end")
+    template_ext = (".sql",)
 
     @apply_defaults
     def __init__(self,
@@ -18,6 +20,10 @@ class LoadFactOperator(BaseOperator):
                  fact_cols: str,
                  sql: str,
                  truncate: bool,
+                 window_start: str = None,
+                 window_end: str = None,
+                 time_column: str = "start_time",
+                 key_column: str = None,
                  *args, **kwargs):
         """
         :param redshift_conn_id: Connection to Redshift database
@@ -25,6 +31,15 @@ class LoadFactOperator(BaseOperator):
         :param fact_cols: List of column names of fact table as string
         :param sql: SQL statement used to select data that is inserted into fact table
         :param truncate: If True, clear fact table before inserting new data
+        :param window_start: Start of time window to load (inclusive), e.g. "{{ execution_date }}". If given
+        together with window_end, only selected rows within the window are inserted after deleting the rows of the
+        window from the fact table, so that runs can be repeated and backfilled (in parallel only if the staging
+        tables are not shared between runs)
+        :param window_end: End of time window to load (exclusive), e.g. "{{ next_execution_date }}"
+        :param time_column: Column of fact table and of the rows selected by sql the window applies to
+        :param key_column: Column of fact table and of the rows selected by sql identifying a row. If given instead of
+        a window, all selected rows are inserted after deleting the rows with their keys from the fact table, e.g. if
+        the staging tables only hold data added since the last run, which may belong to any time
         :param args: Additional arguments
         :param kwargs: Additional keyword arguments
         """
@@ -35,6 +50,10 @@ class LoadFactOperator(BaseOperator):
         self.fact_cols = fact_cols
         self.sql = sql
         self.truncate = truncate
+        self.window_start = window_start
+        self.window_end = window_end
+        self.time_column = time_column
+        self.key_column = key_column
 
     def execute(self, context):
 
@@ -42,6 +61,32 @@ class LoadFactOperator(BaseOperator):
         logging.debug("Connecting to Redshift")
         redshift_hook = PostgresHook(self.redshift_conn_id)
 
+        # replace the rows of the time window only, filtering the selected rows (Redshift pushes the predicate down
+        # into the SELECT), in one transaction
+        if self.window_start and self.window_end:
+            logging.info(f"Loading data from {self.window_start} to {self.window_end} into fact table "
+                         f"{self.fact_table}")
+            window = {"window_start": self.window_start, "window_end": self.window_end}
+            condition = "{column} >= %(window_start)s AND {column} < %(window_end)s"
+            redshift_hook.run([
+                f"DELETE FROM {self.fact_table} WHERE " + condition.format(column=self.time_column),
+                f"INSERT INTO {self.fact_table} ({self.fact_cols}) "
+                f"SELECT * FROM ({self.sql.strip().rstrip(';')}) AS selected "
+                f"WHERE " + condition.format(column=f"selected.{self.time_column}")
+            ], parameters=window)
+            return
+
+        # replace the rows with the keys of the selected rows in one transaction
+        if self.key_column:
+            logging.info(f"Merging data into fact table {self.fact_table} on {self.key_column}")
+            selected = f"FROM ({self.sql.strip().rstrip(';')}) AS selected"
+            redshift_hook.run([
+                f"DELETE FROM {self.fact_table} WHERE {self.key_column} IN "
+                f"(SELECT selected.{self.key_column} {selected})",
+                f"INSERT INTO {self.fact_table} ({self.fact_cols}) SELECT * {selected}"
+            ])
+            return
+
         # clear fact table if desired
         if self.truncate:
             redshift_hook.run(f"TRUNCATE {self.fact_table}")
@@ -1,5 +1,9 @@
+import json
 import logging
+from datetime import timedelta, timezone
+from psycopg2.extras import execute_values
 from airflow.hooks.postgres_hook import PostgresHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
@@ -9,7 +13,27 @@ class StageToRedshiftOperator(BaseOperator):
     Custom operator capable of loading CSV/JSON-formatted files from AWS S3 to AWS Redshift.
     """
     ui_color = '#358140'
-    template_fields = ("aws_iam_role", "s3_bucket", "s3_key", "s3_region", "redshift_table", "json_path")
+    template_fields = ("aws_iam_role", "s3_bucket", "s3_key", "s3_region", "redshift_table", "json_path",
+                       "manifest_prefix")
+
+    copy_template = """
+        COPY {redshift_table}
+        FROM '{source}'
+        CREDENTIALS 'aws_iam_role={aws_iam_role}'
+        REGION '{s3_region}'
+        COMPUPDATE OFF
+        STATUPDATE OFF
+        JSON '{json_path}'
+        TRUNCATECOLUMNS
+        {manifest}
+        """
+
+    state_lock = "LOCK load_state"
+    state_select = "SELECT MAX(last_modified) FROM load_state WHERE table_name = %s AND source = %s"
+    state_keys_select = ("SELECT object_key FROM load_state "
+                         "WHERE table_name = %s AND source = %s AND last_modified >= %s")
+    state_prune = "DELETE FROM load_state WHERE table_name = %s AND source = %s AND last_modified < %s"
+    state_insert = "INSERT INTO load_state (table_name, source, object_key, last_modified) VALUES %s"
 
     @apply_defaults
     def __init__(self,
@@ -20,6 +44,11 @@ class StageToRedshiftOperator(BaseOperator):
                  s3_region: str,
                  redshift_table: str,
                  json_path: str,
+                 truncate: bool = False,
+                 incremental: bool = False,
+                 aws_conn_id: str = "aws_default",
+                 manifest_prefix: str = None,
+                 lag: timedelta = timedelta(hours=1),
                  *args, **kwargs):
         """
         :param aws_iam_role: AWS IAM role required for COPY command
@@ -29,6 +58,13 @@ class StageToRedshiftOperator(BaseOperator):
         :param s3_region: AWS region, e.g. us-west-2, where the bucket is located
         :param redshift_table: Name of Redshift table in which data is loaded
         :param json_path: Path to JSON file containing information how to handle data in S3 bucket
+        :param truncate: If True, clear staging table before loading data
+        :param incremental: If True, only load objects added since the last successful load (c.f. load_state table)
+        via a COPY manifest
+        :param aws_conn_id: Connection to AWS used to list objects and write manifests in incremental mode
+        :param manifest_prefix: S3 URL to write manifests to in incremental mode, e.g. s3://my-bucket/manifests
+        :param lag: Time objects may show up late in listings in incremental mode (e.g. multipart uploads are dated by
+        their start), objects up to lag before the latest loaded one are listed again and filtered by their keys
         :param args: Additional arguments
         :param kwargs: Additional keyword arguments
         """
@@ -41,34 +77,133 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_region = s3_region
         self.redshift_table = redshift_table
         self.json_path = json_path
+        self.truncate = truncate
+        self.incremental = incremental
+        self.aws_conn_id = aws_conn_id
+        self.manifest_prefix = manifest_prefix
+        self.lag = lag
 
-    def execute(self, context):
+        if incremental and not manifest_prefix:
+            raise ValueError("manifest_prefix is required in incremental mode")
+
+    def list_new_objects(self, s3_hook: S3Hook, since=None, loaded: set = frozenset()) -> list:
+        """
+        List the objects below s3_key which have not been loaded yet, i.e. which have been modified at or after since
+        and whose keys are not among the loaded ones.
+        :param s3_hook: S3 hook
+        :param since: Last modified timestamp (UTC) to list objects from, None to list all objects
+        :param loaded: Keys of objects modified at or after since which have already been loaded
+        :return: List of tuples of last modified, key and size, ordered by last modified and key
+        """
+        objects = []
+        for obj in s3_hook.get_bucket(self.s3_bucket).objects.filter(Prefix=self.s3_key):
+            if obj.key.endswith("/") or not obj.size:
+                continue
+            last_modified = obj.last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+            if (since is None or last_modified >= since) and obj.key not in loaded:
+                objects.append((last_modified, obj.key, obj.size))
 
-        # define sql template
-        sql_template = """
-            COPY {redshift_table}
-            FROM 's3://{s3_bucket}/{s3_key}'
-            CREDENTIALS 'aws_iam_role={aws_iam_role}'
-            REGION '{s3_region}'
-            COMPUPDATE OFF
-            STATUPDATE OFF
-            JSON '{json_path}'
-            TRUNCATECOLUMNS
-            """
+        return sorted(objects)
+
+    def write_manifest(self, s3_hook: S3Hook, objects: list, context) -> str:
+        """
+        Write a COPY manifest listing the given objects to manifest_prefix.
+        :param s3_hook: S3 hook
+        :param objects: List of tuples of last modified, key and size as returned by list_new_objects
+        :param context: Task context
+        :return: S3 URL of manifest
+        """
+        manifest = {"entries": [{"url": f"s3://{self.s3_bucket}/{key}", "mandatory": True,
+                                 "meta": {"content_length": size}} for _, key, size in objects]}
+
+        bucket, _, prefix = self.manifest_prefix.replace("s3://", "", 1).partition("/")
+        key = f"{prefix.rstrip('/')}/{self.redshift_table}/{context['ts_nodash']}.manifest".lstrip("/")
+        s3_hook.load_string(json.dumps(manifest), key=key, bucket_name=bucket, replace=True)
+
+        return f"s3://{bucket}/{key}"
+
+    def execute(self, context):
 
         # connect to redshift
         logging.debug("Connecting to Redshift")
         redshift_hook = PostgresHook(self.redshift_conn_id)
 
-        # copy data from s3 to redshift
-        sql = sql_template.format(
-            redshift_table = self.redshift_table,
-            aws_iam_role = self.aws_iam_role,
-            s3_bucket = self.s3_bucket,
-            s3_key = self.s3_key,
-            s3_region = self.s3_region,
-            json_path = self.json_path
-        )
+        source = f"s3://{self.s3_bucket}/{self.s3_key}"
+
+        # copy data from s3 to redshift in one transaction
+        conn = redshift_hook.get_conn()
+        try:
+            with conn.cursor() as cur:
+                if self.incremental:
+                    self.stage_new_objects(cur, source, context)
+                else:
+                    self.clear(cur)
+                    logging.info(f"Staging data from {self.s3_bucket}/{self.s3_key} to {self.redshift_table}")
+                    cur.execute(self.copy_sql(source))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear(self, cur) -> None:
+        """
+        Clear the staging table if desired (DELETE instead of TRUNCATE, which would commit immediately).
+        :param cur: Cursor
+        :return: None
+        """
+        if self.truncate:
+            cur.execute(f"DELETE FROM {self.redshift_table}")
+
+    def stage_new_objects(self, cur, source: str, context) -> int:
+        """
+        Load the objects which have not been loaded from source yet via a COPY manifest and record them in
+        load_state. load_state is locked before it is read, so concurrent runs wait for each other instead of loading
+        the same objects. Only objects within lag of the latest loaded one are kept in load_state. Without new objects
+        the staging table is cleared nevertheless (if truncate is set), so that its rows are not loaded twice.
+        :param cur: Cursor, nothing is committed
+        :param source: S3 URL of source prefix
+        :param context: Task context
+        :return: Number of loaded objects
+        """
+        cur.execute(self.state_lock)
+        cur.execute(self.state_select, (self.redshift_table, source))
+        latest = cur.fetchone()[0]
+        since, loaded = None, set()
+        if latest is not None:
+            since = latest - self.lag
+            cur.execute(self.state_keys_select, (self.redshift_table, source, since))
+            loaded = {key for key, in cur.fetchall()}
+
+        s3_hook = S3Hook(self.aws_conn_id)
+        objects = self.list_new_objects(s3_hook, since, loaded)
+        if not objects:
+            logging.info(f"No new objects in {source} since {since or 'the beginning'}")
+            self.clear(cur)
+            return 0
+
+        manifest_url = self.write_manifest(s3_hook, objects, context)
+        logging.info(f"Staging {len(objects)} new objects from {source} to {self.redshift_table} via {manifest_url}")
+
+        # load new objects and record them in the same transaction
+        keep_since = max([objects[-1][0]] + ([latest] if latest else [])) - self.lag
+        self.clear(cur)
+        cur.execute(self.copy_sql(manifest_url, "MANIFEST"))
+        cur.execute(self.state_prune, (self.redshift_table, source, keep_since))
+        execute_values(cur, self.state_insert, [(self.redshift_table, source, key, last_modified)
+                                                for last_modified, key, _ in objects if last_modified >= keep_since])
+        return len(objects)
 
-        logging.info(f"Staging data from {self.s3_bucket}/{self.s3_key} to {self.redshift_table}")
-        redshift_hook.run(sql)
+    def copy_sql(self, source: str, manifest: str = "") -> str:
+        """
+        Render the COPY statement.
+        :param source: S3 URL of data or manifest
+        :param manifest: MANIFEST if source is a manifest
+        :return: SQL statement
+        """
+        return self.copy_template.format(
+            redshift_table=self.redshift_table,
+            source=source,
+            aws_iam_role=self.aws_iam_role,
+            s3_region=self.s3_region,
+            json_path=self.json_path,
+            manifest=manifest
+        )
@@ -81,3 +81,11 @@ CREATE TABLE IF NOT EXISTS public.users (
 	"level" varchar(256),
 	CONSTRAINT users_pkey PRIMARY KEY (userid)
 );
+
+CREATE TABLE IF NOT EXISTS public.load_state (
+	table_name varchar(256) NOT NULL,
+	source varchar(1024) NOT NULL,
+	object_key varchar(1024) NOT NULL,
+	last_modified timestamp NOT NULL,
+	loaded_at timestamp DEFAULT GETDATE()
+);
@@ -1,17 +1,19 @@
 SELECT
-    md5(events.sessionid || events.start_time) songplay_id,
+    md5(events.sessionid || events.start_time) playid,
     events.start_time,
     events.userid,
     events.level,
-    songs.song_id,
-    songs.artist_id,
+    songs.songid,
+    songs.artistid,
     events.sessionid,
     events.location,
     events.useragent
 FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time, *
       FROM staging_events
       WHERE page='NextSong') events
-         LEFT JOIN staging_songs songs
+         LEFT JOIN (SELECT songs.songid, songs.artistid, songs.title, artists.name, songs.duration
+                    FROM songs
+                             JOIN artists ON songs.artistid = artists.artistid) songs
                    ON events.song = songs.title
-                       AND events.artist = songs.artist_name
+                       AND events.artist = songs.name
                        AND events.length = songs.duration
\ No newline at end of file
@@ -1,3 +1,5 @@
 SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time),
        extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
-FROM songplays
\ No newline at end of file
+FROM (SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time
+      FROM staging_events
+      WHERE page='NextSong') events
\ No newline at end of file
@@ -1,3 +1,6 @@
-SELECT distinct userid, firstname, lastname, gender, level
-FROM staging_events
-WHERE page='NextSong'
\ No newline at end of file
+SELECT userid, firstname, lastname, gender, level
+FROM (SELECT userid, firstname, lastname, gender, level,
+             ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS recency
+      FROM staging_events
+      WHERE page='NextSong') events
+WHERE recency = 1
\ No newline at end of file
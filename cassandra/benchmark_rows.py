@@ -0,0 +1,65 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from helpers import convert_to_none, to_rows
+
+
+def make_events(n: int) -> pd.DataFrame:
+    """
+    Generate n synthetic events resembling event_datafile_new.csv, including missing values.
+
+    :param n: Number of rows
+    :return: Dataframe with int, float and text columns
+    """
+    rng = np.random.RandomState(42)
+    df = pd.DataFrame({
+        "sessionId": rng.randint(1, 1000, n),
+        "itemInSession": rng.randint(0, 100, n),
+        "artist": rng.choice(["Muse", "Coldplay", "Björk", None], n),
+        "song": rng.choice(["Uprising", "Yellow", "Jóga", None], n),
+        "length": rng.uniform(30, 600, n),
+        "userId": rng.randint(1, 100, n).astype(float)
+    })
+    df.loc[rng.rand(n) < 0.05, ["length", "userId"]] = np.nan
+
+    return df
+
+
+def rows_iterrows(df: pd.DataFrame) -> list:
+    """
+    Materialize rows the way batch_insert used to, i.e. convert_to_none followed by iterrows.
+    """
+    return [list(row) for _, row in convert_to_none(df).iterrows()]
+
+
+def rows_columnar(df: pd.DataFrame) -> list:
+    """
+    Materialize rows via to_rows with the CQL types of song_playlist_session/song_playlist_user.
+    """
+    return to_rows(df, ["int", "int", "text", "text", "float", "float"])
+
+
+def main():
+    """
+    Compare the row materialization of convert_to_none + iterrows to to_rows.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark row materialization for Cassandra inserts")
+    parser.add_argument("--rows", type=int, default=1000000, help="number of synthetic rows")
+    args = parser.parse_args()
+
+    df = make_events(args.rows)
+    print(f"Materializing {args.rows} rows")
+
+    timings = {}
+    for name, func in [("iterrows", rows_iterrows), ("to_rows", rows_columnar)]:
+        start = time.perf_counter()
+        func(df)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:<10} {timings[name]:>8.2f}s {args.rows / timings[name]:>12.0f} rows/s")
+
+    print(f"Speedup: {timings['iterrows'] / timings['to_rows']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
-import subprocess
+import re
+import csv
+import mmap
+import time
+import weakref
 from pprint import pprint
-from itertools import zip_longest
+from collections import OrderedDict
+from itertools import zip_longest, islice
+from typing import Iterator
 import pandas as pd
 import numpy as np
 import cassandra
-from cassandra.query import BatchStatement
+from cassandra.query import BatchStatement, BatchType
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent
+from queries import table_create_queries
 
 
 def load_all_records(file_list: list, columns: list) -> pd.DataFrame:
@@ -37,6 +45,79 @@ def convert_to_none(df: pd.DataFrame) -> pd.DataFrame:
         return df
     
     
+# Python types of values sent to Cassandra by CQL type, c.f. to_rows
+CQL_PYTHON_TYPES = {
+    "int": int,
+    "bigint": int,
+    "smallint": int,
+    "varint": int,
+    "float": float,
+    "double": float,
+    "boolean": bool,
+    "text": str,
+    "varchar": str,
+    "ascii": str
+}
+
+
+def get_cql_types(session: cassandra.cluster.Session, table: str, cols: list) -> list:
+    """
+    Return the CQL types of the given columns of a table in the session's keyspace.
+
+    :param session: Apache Cassandra session
+    :param table: Name of Cassandra table
+    :param cols: Column names, matched case-insensitively
+    :return: List of CQL types, e.g. ["int", "text"]
+    """
+    table_cols = session.cluster.metadata.keyspaces[session.keyspace].tables[table].columns
+
+    return [table_cols[col.lower()].cql_type for col in cols]
+
+
+def to_column(series: pd.Series, cql_type: str = None) -> np.ndarray:
+    """
+    Convert a column into an object array of Python values matching the given CQL type (or the
+    column's dtype if no type is given) with None for missing values.
+    """
+    mask = series.isnull().to_numpy()
+    py_type = CQL_PYTHON_TYPES.get(cql_type)
+
+    if py_type is None:
+        py_type = {"i": int, "u": int, "f": float, "b": bool}.get(series.dtype.kind)
+
+    # numpy converts int64/float64/bool arrays to Python scalars when casting to object
+    if py_type is int:
+        values = series.fillna(0).to_numpy().astype(np.int64).astype(object)
+    elif py_type is float:
+        values = series.to_numpy().astype(np.float64).astype(object)
+    elif py_type is bool:
+        values = series.fillna(False).to_numpy().astype(bool).astype(object)
+    elif py_type is str and series.dtype.kind != "O":
+        values = series.astype(str).to_numpy(dtype=object)
+    else:
+        values = series.to_numpy(dtype=object, copy=True)
+
+    if mask.any():
+        values[mask] = None
+
+    return values
+
+
+def to_rows(data: pd.DataFrame, cql_types: list = None) -> list:
+    """
+    Turn a dataframe into a list of driver-ready tuples in one pass over its columns, i.e. without
+    copying the whole dataframe (c.f. convert_to_none) or materializing a Series per row (iterrows).
+
+    :param data: Data to be inserted, columns ordered like the parameters of the insert statement
+    :param cql_types: CQL types of the columns of data, c.f. get_cql_types
+    :return: List of tuples with Python values and None for missing values
+    """
+    cql_types = cql_types or [None] * data.shape[1]
+    columns = [to_column(data.iloc[:, i], cql_type) for i, cql_type in enumerate(cql_types)]
+
+    return list(zip(*columns))
+
+
 def make_split(data: pd.DataFrame, size: int = 500) -> list:
     """
     Split dataframe into n subframes, where n is determined by number of
@@ -56,8 +137,89 @@ def make_split(data: pd.DataFrame, size: int = 500) -> list:
     return splitted_data
         
 
+def get_partition_key(table: str, columns: list = None) -> tuple:
+    """
+    Read the partition key of a table from its create statement in queries.py. Since unquoted
+    CQL identifiers are case-insensitive, key columns are optionally mapped onto the matching
+    (e.g. camelCase) names in columns.
+
+    :param table: Name of Cassandra table, c.f. table_create_queries
+    :param columns: Column names of data to be inserted into table
+    :return: Tuple containing the partition key column(s)
+    """
+    primary_key = re.search(r"PRIMARY KEY\s*\((.*)\)", table_create_queries[table]).group(1).strip()
+
+    # composite partition keys are enclosed in parentheses, e.g. ((userId, sessionId), itemInSession)
+    if primary_key.startswith("("):
+        partition_key = primary_key[1:primary_key.index(")")]
+    else:
+        partition_key = primary_key.split(",")[0]
+
+    key_cols = [e.strip() for e in partition_key.split(",")]
+
+    if columns is not None:
+        lookup = {col.lower(): col for col in columns}
+        key_cols = [lookup[e.lower()] for e in key_cols]
+
+    return tuple(key_cols)
+
+
+def make_token_split(data: pd.DataFrame, table: str, query: cassandra.query.PreparedStatement,
+                     session: cassandra.cluster.Session, size: int = 500, cql_types: list = None) -> list:
+    """
+    Split dataframe along the partitions of a table instead of evenly (c.f. make_split): rows are
+    grouped by the table's partition key, partitions are ordered by the replica owning them and their
+    token, and whole partitions are packed into splits of about size rows which never span several
+    replicas. Partitions larger than size are split on their own. Batches built from such a split are
+    routed to a replica by the driver's token-aware load balancing policy.
+
+    :param data: Data to be split, columns ordered like the parameters of query
+    :param table: Name of Cassandra table, c.f. table_create_queries
+    :param query: Prepared CQL insert statement for table
+    :param session: Apache Cassandra session
+    :param size: Length of split
+    :param cql_types: CQL types of the columns of data, c.f. get_cql_types
+    :return: List containing splitted dataframes
+    """
+    partition_key = get_partition_key(table, data.columns)
+    token_map = session.cluster.metadata.token_map
+
+    # determine token and primary replica of each partition
+    partitions = []
+    for _, group in data.groupby(list(partition_key), sort=False):
+        owner, token = "", 0
+        if token_map is not None:
+            routing_key = query.bind(to_rows(group.iloc[:1], cql_types)[0]).routing_key
+            token = token_map.token_class.from_key(routing_key)
+            replicas = token_map.get_replicas(session.keyspace, token)
+            owner, token = (str(replicas[0].address) if replicas else ""), token.value
+        partitions.append((owner, token, group))
+
+    partitions.sort(key=lambda e: (e[0], e[1]))
+
+    # pack partitions into splits
+    splits, current, current_owner, current_rows = [], [], None, 0
+    for owner, _, group in partitions:
+        if current and (owner != current_owner or current_rows + len(group) > size):
+            splits.append(pd.concat(current))
+            current, current_rows = [], 0
+
+        if len(group) > size:
+            splits.extend(group.iloc[i:i + size] for i in range(0, len(group), size))
+            continue
+
+        current.append(group)
+        current_owner = owner
+        current_rows += len(group)
+
+    if current:
+        splits.append(pd.concat(current))
+
+    return splits
+
+
 def batch_insert(cql: str, cols: tuple, data: pd.DataFrame, size: int, 
-                 session: cassandra.cluster.Session):
+                 session: cassandra.cluster.Session, token_aware: bool = False):
     """
     Given an Apache Cassandra session, use the provided CQL statement to insert via batches.
     http://datastax.github.io/python-driver/api/cassandra/query.html#module-cassandra.query
@@ -67,22 +229,28 @@ def batch_insert(cql: str, cols: tuple, data: pd.DataFrame, size: int,
     :param data: Data to be inserted
     :param size: Size of batch
     :param session: Apache Cassandra session
+    :param token_aware: If True, build replica-local unlogged batches via make_token_split
     """
     query = session.prepare(cql)
-    # convert NaNs to None and subset input data
-    converted_data = convert_to_none(data[cols])
-    splits = make_split(converted_data, size)
+    # subset input data, NaNs are converted to None per split (c.f. to_rows)
+    subset_data = data[list(cols)]
+    cql_types = get_cql_types(session, get_table(cql), cols) if session.keyspace else None
+
+    if token_aware:
+        splits = make_token_split(subset_data, get_table(cql), query, session, size, cql_types)
+    else:
+        splits = make_split(subset_data, size)
     
     # generate batches
-    print(f"Starting batch insert for {converted_data.shape[0]} rows in {len(splits)} batches of size {size}")
+    print(f"Starting batch insert for {subset_data.shape[0]} rows in {len(splits)} batches of size {size}")
     
     for ix, split in enumerate(splits):
         try:
-            batch = BatchStatement()
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED if token_aware else BatchType.LOGGED)
             
             # add rows of splits to batch
-            for _, row in split.iterrows():
-                batch.add(query, list(row))
+            for row in to_rows(split, cql_types):
+                batch.add(query, row)
             
             session.execute(batch)
             print(f"Inserted {len(split)} rows of data")
@@ -93,6 +261,133 @@ def batch_insert(cql: str, cols: tuple, data: pd.DataFrame, size: int,
     print("Batch insert finished")
         
         
+def get_table(cql: str) -> str:
+    """
+    Return the name of the table targeted by a CQL insert statement.
+    """
+    return re.search(r"INSERT\s+INTO\s+(?:\w+\.)?(\w+)", cql, re.IGNORECASE).group(1)
+
+
+def make_statements(query: cassandra.query.PreparedStatement, data: pd.DataFrame, partition_key: tuple = None,
+                    size: int = 50, cql_types: list = None) -> list:
+    """
+    Turn rows of data into (statement, parameters) pairs for execute_concurrent. Without a partition key
+    every row is bound individually, otherwise rows are grouped by partition key and each group is
+    split into unlogged batches of at most size rows - i.e. every batch only touches a single partition.
+    Rows with a missing partition key are dropped, since Cassandra would reject them anyway.
+
+    :param query: Prepared CQL insert statement
+    :param data: Data to be inserted, columns ordered like the statement's parameters
+    :param partition_key: Columns making up the partition key of the target table
+    :param size: Maximum number of rows per batch
+    :param cql_types: CQL types of the columns of data, c.f. get_cql_types
+    :return: List of tuples containing a statement, its parameters and the number of rows it inserts
+    """
+    rows = to_rows(data, cql_types)
+
+    if not partition_key:
+        return [(query, row, 1) for row in rows]
+
+    statements = []
+    for indexes in data.groupby(list(partition_key), sort=False).indices.values():
+        for i in range(0, len(indexes), size):
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for ix in indexes[i:i + size]:
+                batch.add(query, rows[ix])
+            statements.append((batch, None, len(indexes[i:i + size])))
+
+    return statements
+
+
+def concurrent_insert(cql: str, cols: list, data: pd.DataFrame, session: cassandra.cluster.Session,
+                      concurrency: int = 100, partition_key: tuple = None, size: int = 50,
+                      retries: int = 3, token_aware: bool = False) -> dict:
+    """
+    Given an Apache Cassandra session, use the provided CQL statement to insert data asynchronously
+    with at most concurrency requests in flight. Optionally group rows into partition-local unlogged
+    batches (c.f. make_statements). Failed requests are retried up to retries times before their rows
+    are reported as failed.
+    https://datastax.github.io/python-driver/api/cassandra/concurrent.html
+
+    :param cql: CQL insert statement
+    :param cols: Columns in which data is inserted
+    :param data: Data to be inserted
+    :param session: Apache Cassandra session
+    :param concurrency: Maximum number of requests in flight
+    :param partition_key: Columns making up the partition key of the target table, e.g. ("sessionId",)
+    :param size: Maximum number of rows per batch if partition_key is given
+    :param retries: Number of retries of failed requests
+    :param token_aware: If True, build replica-local unlogged batches via make_token_split
+    :return: Dictionary containing the number of inserted and failed rows as well as retried requests
+    """
+    query = session.prepare(cql)
+    # subset input data, NaNs are converted to None by to_rows
+    subset_data = data[list(cols)]
+    cql_types = get_cql_types(session, get_table(cql), cols) if session.keyspace else None
+
+    if token_aware:
+        pending = []
+        for split in make_token_split(subset_data, get_table(cql), query, session, size, cql_types):
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for row in to_rows(split, cql_types):
+                batch.add(query, row)
+            pending.append((batch, None, len(split)))
+    else:
+        pending = make_statements(query, subset_data, partition_key, size, cql_types)
+
+    print(f"Starting concurrent insert for {subset_data.shape[0]} rows in {len(pending)} requests "
+          f"with concurrency {concurrency}")
+    start = time.perf_counter()
+    stats = execute_with_retries(session, pending, concurrency, retries)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"Concurrent insert finished: {stats['inserted']} rows in {elapsed:.1f}s "
+          f"({stats['inserted'] / elapsed:.0f} rows/s)")
+
+    return stats
+
+
+def execute_with_retries(session: cassandra.cluster.Session, pending: list, concurrency: int,
+                         retries: int) -> dict:
+    """
+    Execute (statement, parameters, number of rows) tuples concurrently with at most concurrency
+    requests in flight and retry failed requests up to retries times with exponential backoff.
+
+    :param session: Apache Cassandra session
+    :param pending: List of tuples containing a statement, its parameters and the number of rows it inserts
+    :param concurrency: Maximum number of requests in flight
+    :param retries: Number of retries of failed requests
+    :return: Dictionary containing the number of inserted and failed rows as well as retried requests
+    """
+    stats = {"inserted": 0, "failed": 0, "retried": 0}
+
+    for attempt in range(retries + 1):
+        if attempt:
+            stats["retried"] += len(pending)
+            time.sleep(min(2 ** attempt * 0.1, 5))
+
+        results = execute_concurrent(session, [(stmt, params) for stmt, params, _ in pending],
+                                     concurrency=concurrency, raise_on_first_error=False)
+
+        failed = []
+        for (success, result), item in zip(results, pending):
+            if success:
+                stats["inserted"] += item[2]
+            else:
+                failed.append(item)
+                error = result
+
+        pending = failed
+        if not pending:
+            break
+
+    if pending:
+        stats["failed"] = sum(item[2] for item in pending)
+        print(f"Insert failed for {stats['failed']} rows: {error}")
+
+    return stats
+
+
 def query(cql: str, session: cassandra.cluster.Session, print_result: bool = True):
     """
     Given CQL query and Cassandra session, send query to
@@ -110,20 +405,224 @@ def query(cql: str, session: cassandra.cluster.Session, print_result: bool = Tru
     return res
 
 
-def batch_copy(keyspace: str, table: str, file_path: str, fname: str):
+class ResultCache:
     """
-    Given an existing keyspace and table, insert data into table from CSV file via
-    Cassandra's shell - it ain't pretty, but it works ;-) 
-    https://docs.datastax.com/en/cql/3.3/cql/cql_reference/cqlshCopy.html
-    
+    Least recently used cache for query results keyed on (statement, parameters), whose entries
+    expire ttl seconds after they have been stored.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60.0):
+        """
+        :param maxsize: Maximum number of cached results
+        :param ttl: Time to live of cached results in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: tuple):
+        """
+        Return the cached result for key or None if there is no (valid) result.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, result = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: tuple, result):
+        """
+        Store result for key and evict the least recently used entry if the cache is full.
+        """
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# prepared statements by session and CQL statement, c.f. prepare
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+def prepare(cql: str, session: cassandra.cluster.Session) -> cassandra.query.PreparedStatement:
+    """
+    Prepare a CQL statement once per session and return the cached prepared statement afterwards.
+
+    :param cql: CQL statement with ? placeholders
+    :param session: Apache Cassandra session
+    :return: Prepared statement
+    """
+    statements = _prepared_statements.setdefault(session, {})
+    if cql not in statements:
+        statements[cql] = session.prepare(cql)
+
+    return statements[cql]
+
+
+def iter_query(cql: str, params: tuple, session: cassandra.cluster.Session,
+               fetch_size: int = 5000) -> Iterator:
+    """
+    Given a parametrized CQL query and its parameters, execute the (prepared) query and lazily
+    yield its rows, fetching fetch_size rows per page from Cassandra.
+
+    :param cql: CQL statement with ? placeholders
+    :param params: Parameters bound to the placeholders
+    :param session: Apache Cassandra session
+    :param fetch_size: Number of rows per page
+    :return: Iterator over rows
+    """
+    statement = prepare(cql, session).bind(params)
+    statement.fetch_size = fetch_size
+
+    # the result set fetches further pages transparently while iterating
+    yield from session.execute(statement)
+
+
+def prepared_query(cql: str, params: tuple, session: cassandra.cluster.Session, fetch_size: int = 5000,
+                   cache: ResultCache = None, print_result: bool = False) -> list:
+    """
+    Like query, but for parametrized CQL queries (e.g. q1_select and q1_params from queries.py):
+    the query is prepared once per session, its parameters are bound, results are fetched in pages
+    of fetch_size rows and optionally served from / stored in cache.
+
+    :param cql: CQL statement with ? placeholders
+    :param params: Parameters bound to the placeholders
+    :param session: Apache Cassandra session
+    :param fetch_size: Number of rows per page
+    :param cache: Optional result cache
+    :param print_result: Boolean indicating whether to print query result
+    :return: List of rows
+    """
+    key = (cql, tuple(params))
+    res = cache.get(key) if cache is not None else None
+
+    if res is None:
+        res = list(iter_query(cql, params, session, fetch_size))
+        if cache is not None:
+            cache.put(key, res)
+
+    if print_result:
+        pprint(res)
+
+    return res
+
+
+def parse_int(value: str) -> int:
+    """
+    Parse an integer which might have been written as float (e.g. "26.0") by pandas.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+# converters from CSV strings to Python types by CQL type, c.f. batch_copy
+CQL_CONVERTERS = {
+    "int": parse_int,
+    "bigint": parse_int,
+    "smallint": parse_int,
+    "varint": parse_int,
+    "float": float,
+    "double": float,
+    "decimal": float,
+    "boolean": lambda value: value.lower() in ("true", "1", "yes"),
+    "text": str,
+    "varchar": str,
+    "ascii": str
+}
+
+
+def iter_csv_chunks(file_path: str, fname: str, chunk_size: int) -> tuple:
+    """
+    Memory-map a CSV file and parse it lazily, returning its header and an iterator over chunks
+    of at most chunk_size parsed rows. Only the current chunk is held in memory.
+
+    :param file_path: Path to directory were file to copy is stored
+    :param fname: Name of the file to copy
+    :param chunk_size: Number of rows per chunk
+    :return: Tuple containing the header and an iterator over lists of rows
+    """
+    f = open(f"{file_path}/{fname}", "rb")
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    reader = csv.reader(line.decode("utf-8") for line in iter(mm.readline, b""))
+    header = next(reader)
+
+    def chunks():
+        try:
+            while True:
+                chunk = list(islice(reader, chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            mm.close()
+            f.close()
+
+    return header, chunks()
+
+
+def batch_copy(keyspace: str, table: str, file_path: str, fname: str, session: cassandra.cluster.Session,
+               cols: list = None, chunk_size: int = 10000, concurrency: int = 100, retries: int = 3) -> dict:
+    """
+    Given an existing keyspace and table, insert data into table from a CSV file (with header).
+    The file is memory-mapped and parsed in chunks, values are converted according to the table's
+    CQL column types and each chunk is written via the table's prepared insert statement with at most
+    concurrency requests in flight (c.f. execute_with_retries). Rows/s, errors and retries are printed
+    per chunk.
+
     :param keyspace: Cassandra keyspace
     :param table: Cassandra table to copy data to
     :param file_path: Path to directory were file(s) to copy are stored
     :param fname: Name of the file to copy
+    :param session: Apache Cassandra session
+    :param cols: Columns of file to copy, defaults to all columns of file which exist in table
+    :param chunk_size: Number of rows per chunk
+    :param concurrency: Maximum number of requests in flight
+    :param retries: Number of retries of failed requests
+    :return: Dictionary containing the number of inserted and failed rows as well as retried requests
     """
-    cqlsc = f"COPY {keyspace}.{table} FROM '{file_path}/{fname}' WITH HEADER = TRUE"
-    try:
-        subprocess.check_call(["cqlsh", cqlsc], shell=False)
-        print("Batch copy succeeded")
-    except Exception as e:
-        print(f"Batch copy failed: {e}")
\ No newline at end of file
+    header, chunks = iter_csv_chunks(file_path, fname, chunk_size)
+
+    # map columns of file to columns of table (unquoted CQL identifiers are lower case)
+    table_cols = session.cluster.metadata.keyspaces[keyspace].tables[table].columns
+    cols = cols or [col for col in header if col.lower() in table_cols]
+    indexes = [header.index(col) for col in cols]
+    converters = [CQL_CONVERTERS.get(table_cols[col.lower()].cql_type, str) for col in cols]
+
+    query = session.prepare(f"INSERT INTO {keyspace}.{table} ({', '.join(cols)}) "
+                            f"VALUES ({', '.join('?' for _ in cols)})")
+    print(f"Starting batch copy of {file_path}/{fname} into {keyspace}.{table} ({', '.join(cols)})")
+    stats = {"inserted": 0, "failed": 0, "retried": 0}
+
+    for ix, chunk in enumerate(chunks):
+        start = time.perf_counter()
+        pending = []
+        for row in chunk:
+            try:
+                values = tuple(convert(row[i]) if row[i] != "" else None for i, convert in zip(indexes, converters))
+                pending.append((query, values, 1))
+            except (ValueError, IndexError):
+                stats["failed"] += 1
+
+        chunk_stats = execute_with_retries(session, pending, concurrency, retries)
+        for key, value in chunk_stats.items():
+            stats[key] += value
+
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print(f"Chunk {ix}: inserted {chunk_stats['inserted']} rows ({chunk_stats['inserted'] / elapsed:.0f} rows/s), "
+              f"{len(chunk) - chunk_stats['inserted']} errors, {chunk_stats['retried']} retries")
+
+    print(f"Batch copy finished: {stats['inserted']} rows inserted, {stats['failed']} rows failed")
+
+    return stats
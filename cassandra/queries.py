@@ -26,6 +26,15 @@ FROM song_playlist_session
 WHERE sessionId = 338 AND itemInSession = 4
 """
 
+# parametrized version of q1_query, c.f. helpers.prepared_query
+q1_select = """
+SELECT artist, song, length
+FROM song_playlist_session
+WHERE sessionId = ? AND itemInSession = ?
+"""
+
+q1_params = (338, 4)
+
 # query 2
 q2_drop_table = """
 DROP TABLE IF EXISTS song_playlist_user
@@ -52,6 +61,14 @@ FROM song_playlist_user
 WHERE userId = 10 AND sessionId = 182
 """
 
+q2_select = """
+SELECT artist, song, firstName, lastName, itemInSession
+FROM song_playlist_user
+WHERE userId = ? AND sessionId = ?
+"""
+
+q2_params = (10.0, 182)
+
 # query 3
 q3_drop_table = """
 DROP TABLE IF EXISTS song_user_name
@@ -71,4 +88,19 @@ q3_query = """
 SELECT firstName, lastName
 FROM song_user_name
 WHERE song = 'All Hands Against His Own'
-"""
\ No newline at end of file
+"""
+
+q3_select = """
+SELECT firstName, lastName
+FROM song_user_name
+WHERE song = ?
+"""
+
+q3_params = ("All Hands Against His Own",)
+
+# create statements by table, c.f. helpers.get_partition_key
+table_create_queries = {
+    "song_playlist_session": q1_create_table,
+    "song_playlist_user": q2_create_table,
+    "song_user_name": q3_create_table
+}
@@ -0,0 +1,56 @@
+import time
+import argparse
+import pandas as pd
+from etl import get_files, read_song_files
+
+
+def read_song_files_per_file(filepaths: list) -> pd.DataFrame:
+    """
+    Read song files the way process_song_file does, i.e. one pd.read_json call per file,
+    and combine the results into a single dataframe.
+
+    :param filepaths: List of paths to JSON files
+    :return: Dataframe with one row per song record
+    """
+    return pd.DataFrame([pd.read_json(f, orient="records", typ="series", precise_float=True) for f in filepaths])
+
+
+def benchmark(name: str, func, filepaths: list, repeat: int) -> float:
+    """
+    Run func on filepaths repeat times and print the best throughput in files/sec.
+
+    :param name: Name of the benchmark
+    :param func: Function reading a list of files into a dataframe
+    :param filepaths: List of paths to JSON files
+    :param repeat: Number of runs
+    :return: Best throughput in files/sec
+    """
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(filepaths)
+        best = max(best, len(filepaths) / max(time.perf_counter() - start, 1e-9))
+
+    print('{:<12} {:>10.1f} files/s'.format(name, best))
+    return best
+
+
+def main():
+    """
+    Compare reading song files one by one with pd.read_json to reading them in one pass with read_song_files.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark readers for song files")
+    parser.add_argument("--path", default="data/song_data", help="directory containing song files")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs per reader")
+    args = parser.parse_args()
+
+    filepaths = get_files(args.path)
+    print('Reading {} files from {}'.format(len(filepaths), args.path))
+
+    before = benchmark("per file", read_song_files_per_file, filepaths, args.repeat)
+    after = benchmark("batched", read_song_files, filepaths, args.repeat)
+    print('Speedup: {:.1f}x'.format(after / max(before, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,25 @@
+import argparse
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
 
 
-def create_database():
+def create_database(drop: bool = True):
+    """
+    (Re)create the sparkify database and return a cursor and connection to it
+    :param drop: If False, keep an existing sparkify database and its data
+    """
     # connect to default database
     conn = psycopg2.connect("host=127.0.0.1 dbname=rootdb user=root password=r00tp4ss")
     conn.set_session(autocommit=True)
     cur = conn.cursor()
-    
+
+    if drop:
+        cur.execute("DROP DATABASE IF EXISTS sparkifydb")
+
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = 'sparkifydb'")
+    if not cur.fetchone():
+        cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
 
     # close connection to default database
     conn.close()    
@@ -45,9 +54,15 @@ def create_tables(cur, conn):
 
 
 def main():
-    cur, conn = create_database()
-    
-    drop_tables(cur, conn)
+    parser = argparse.ArgumentParser(description="Create Sparkify tables in PostgreSQL")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep existing database and tables (including the manifest of loaded files)")
+    args = parser.parse_args()
+
+    cur, conn = create_database(drop=not args.incremental)
+
+    if not args.incremental:
+        drop_tables(cur, conn)
     create_tables(cur, conn)
 
     conn.close()
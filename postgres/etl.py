@@ -1,20 +1,44 @@
 import os
+import io
+import json
+import hashlib
 import glob
+import time
+import argparse
+import functools
+import multiprocessing
 import psycopg2
 import pandas as pd
 from sql_queries import *
 
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur: psycopg2.extensions.cursor, filepath: str):
+# fixed schema of song files, c.f. read_song_files
+SONG_SCHEMA = {
+    "num_songs": "int64",
+    "artist_id": "object",
+    "artist_latitude": "float64",
+    "artist_longitude": "float64",
+    "artist_location": "object",
+    "artist_name": "object",
+    "song_id": "object",
+    "title": "object",
+    "duration": "float64",
+    "year": "int64"
+}
+
+
+def process_song_file(cur: psycopg2.extensions.cursor, filepath: str) -> int:
     """
     Given a connection (cursor) to a PostgreSQL database and a path to a JSON-(song)-file,
     load the file, and insert valid subsets of its data into song and artist tables.
     
     :param cur: Cursor
     :param filepath: Path to JSON file
+    :return: Number of records processed
     """
     # open song file
-    df = pd.read_json(filepath, orient="records", typ="series")
+    df = pd.read_json(filepath, orient="records", typ="series", precise_float=True)
 
     # insert song record
     song_data = df[["song_id", "title", "artist_id", "year", "duration"]]
@@ -24,37 +48,181 @@ def process_song_file(cur: psycopg2.extensions.cursor, filepath: str):
     artist_data = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
     cur.execute(artist_table_insert, artist_data)
 
+    return 1
+
 
-def process_log_file(cur: psycopg2.extensions.cursor, filepath: str):
+def read_song_files(filepaths: list) -> pd.DataFrame:
     """
-    Given a connection (cursor) to a PostgreSQL database and a path to a JSON-(log)-file,
-    load the file, filter its content, derive datetime attributse from the timestamp column
-    and insert valid subsets of its data into the time, user and songplay tables.
-    
+    Parse many single-record JSON-(song)-files in one pass into a single dataframe with a fixed
+    schema (c.f. SONG_SCHEMA). Unlike calling pd.read_json per file, values are collected in plain
+    column lists by the json module and converted into a columnar dataframe only once.
+
+    :param filepaths: List of paths to JSON files
+    :return: Dataframe with one row per song record
+    """
+    columns = {col: [] for col in SONG_SCHEMA}
+
+    for filepath in filepaths:
+        with open(filepath) as f:
+            record = json.load(f)
+        for col, values in columns.items():
+            values.append(record.get(col))
+
+    df = pd.DataFrame(columns, columns=list(SONG_SCHEMA))
+    for col, dtype in SONG_SCHEMA.items():
+        if dtype != "object":
+            df[col] = pd.to_numeric(df[col]).astype(dtype)
+
+    return df
+
+
+def process_song_files_bulk(cur: psycopg2.extensions.cursor, filepaths: list) -> list:
+    """
+    Given a connection (cursor) to a PostgreSQL database and a list of JSON-(song)-files,
+    read all files at once, stream their song and artist records into temporary staging tables
+    via COPY and merge those into the target tables with set-based upserts.
+
     :param cur: Cursor
+    :param filepaths: List of paths to JSON files
+    :return: Number of records processed per file
+    """
+    df = read_song_files(filepaths)
+
+    # (re)create and clear staging tables
+    for query in song_stage_table_queries:
+        cur.execute(query)
+    cur.execute(song_stage_truncate)
+
+    # stage song and artist records
+    copy_from_df(cur, df[["song_id", "title", "artist_id", "year", "duration"]], "song_stage",
+                 ["song_id", "title", "artist_id", "year", "duration"])
+    copy_from_df(cur, df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]],
+                 "artist_stage", ["artist_id", "name", "location", "latitude", "longitude"])
+
+    # merge staged records into target tables
+    for query in song_merge_table_queries:
+        cur.execute(query)
+
+    return [1] * len(filepaths)
+
+
+def load_log_file(filepath: str) -> pd.DataFrame:
+    """
+    Load a JSON-(log)-file, keep NextSong events only and convert the timestamp column to datetime.
+
     :param filepath: Path to JSON file
+    :return: Dataframe containing NextSong events
     """
-    # open log file
-    df = pd.read_json(filepath, orient="records", lines=True)
+    # open log file, parse floats exactly as the json module does to match song durations
+    df = pd.read_json(filepath, orient="records", lines=True, precise_float=True)
 
     # filter by NextSong action
-    df = df.loc[(df["page"] == "NextSong"), :]
+    df = df.loc[(df["page"] == "NextSong"), :].copy()
 
     # convert timestamp column to datetime
     df["ts"] = df["ts"].astype("datetime64[ms]")
-    
-    # insert time data records
+
+    return df
+
+
+def make_time_df(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Derive datetime attributes for the time table from the timestamp column of a log dataframe.
+
+    :param df: Dataframe as returned by load_log_file
+    :return: Dataframe with columns matching the time table
+    """
     time_dict = {
-    "timestamp": df.ts,
-    "hour": df.ts.dt.hour,
-    "day": df.ts.dt.day,
-    "week_of_year": df.ts.dt.weekofyear,
-    "month": df.ts.dt.month,
-    "year": df.ts.dt.year,
-    "weekday": df.ts.dt.weekday
+        "timestamp": df.ts,
+        "hour": df.ts.dt.hour,
+        "day": df.ts.dt.day,
+        "week_of_year": df.ts.dt.weekofyear,
+        "month": df.ts.dt.month,
+        "year": df.ts.dt.year,
+        "weekday": df.ts.dt.weekday
     }
+
+    return pd.DataFrame.from_dict(time_dict)
+
+
+def make_song_index(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build a lookup index resolving (title, artist_name, duration) to song_id and artist_id.
+    Rows with missing keys are dropped and only the first match per key is kept, just like
+    song_select followed by fetchone.
+
+    :param df: Dataframe with columns title, artist_name, duration, song_id and artist_id
+    :return: Lookup index
+    """
+    keys = ["title", "artist_name", "duration"]
+
+    return df[keys + ["song_id", "artist_id"]].dropna(subset=keys).drop_duplicates(subset=keys)
+
+
+def load_song_index(cur: psycopg2.extensions.cursor) -> pd.DataFrame:
+    """
+    Given a connection (cursor) to a PostgreSQL database, load the song lookup index from the songs
+    and artists tables with a single query.
+
+    :param cur: Cursor
+    :return: Lookup index as returned by make_song_index
+    """
+    cur.execute(song_index_select)
+    df = pd.DataFrame(cur.fetchall(), columns=["title", "artist_name", "duration", "song_id", "artist_id"])
+
+    return make_song_index(df)
+
+
+def load_song_index_from_files(filepaths: list) -> pd.DataFrame:
+    """
+    Load the song lookup index from JSON-(song)-files instead of the database.
+
+    :param filepaths: List of paths to JSON files
+    :return: Lookup index as returned by make_song_index
+    """
+    return make_song_index(read_song_files(filepaths))
+
+
+def resolve_song_ids(df: pd.DataFrame, song_index: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add song_id and artist_id columns to a log dataframe by merging it with the song lookup index
+    on song, artist and length. Durations are compared exactly, events without a match get missing ids.
+
+    :param df: Dataframe as returned by load_log_file
+    :param song_index: Lookup index as returned by make_song_index
+    :return: Copy of df with song_id and artist_id columns
+    """
+    merged = df.merge(song_index, how="left", left_on=["song", "artist", "length"],
+                      right_on=["title", "artist_name", "duration"])
+
+    return merged.drop(columns=["title", "artist_name", "duration"])
+
+
+def process_log_file(cur: psycopg2.extensions.cursor, filepath: str, song_index: pd.DataFrame = None,
+                     replace: bool = False) -> int:
+    """
+    Given a connection (cursor) to a PostgreSQL database and a path to a JSON-(log)-file,
+    load the file, filter its content, derive datetime attributse from the timestamp column
+    and insert valid subsets of its data into the time, user and songplay tables.
     
-    time_df = pd.DataFrame.from_dict(time_dict)
+    :param cur: Cursor
+    :param filepath: Path to JSON file
+    :param song_index: Song lookup index, loaded from the database if not given
+    :param replace: If True, first delete songplays of the file's events (by session, timestamp and user),
+        so that a modified file which has been loaded before does not duplicate its songplays
+    :return: Number of records processed
+    """
+    if song_index is None:
+        song_index = load_song_index(cur)
+
+    df = load_log_file(filepath)
+
+    if replace:
+        cur.execute(songplay_events_delete, (df["sessionId"].tolist(), df["ts"].dt.to_pydatetime().tolist(),
+                                             df["userId"].tolist()))
+
+    # insert time data records
+    time_df = make_time_df(df)
 
     for i, row in time_df.iterrows():
         cur.execute(time_table_insert, list(row))
@@ -66,53 +234,322 @@ def process_log_file(cur: psycopg2.extensions.cursor, filepath: str):
     for i, row in user_df.iterrows():
         cur.execute(user_table_insert, row)
 
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    # get songid and artistid for all songplays at once
+    songplay_df = resolve_song_ids(df, song_index)
+    songplay_df = songplay_df.astype(object).where(songplay_df.notnull(), None)
 
-        # insert songplay record
-        songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
+    # insert songplay records
+    for index, row in songplay_df.iterrows():
+        songplay_data = (row.ts, row.userId, row.level, row.song_id, row.artist_id, row.sessionId, row.location,
+                         row.userAgent)
         cur.execute(songplay_table_insert, songplay_data)
 
+    return len(df)
+
+
+def copy_from_df(cur: psycopg2.extensions.cursor, df: pd.DataFrame, table: str, columns: list):
+    """
+    Stream a dataframe into a table via COPY ... FROM STDIN without writing it to disk first.
+    Missing values are sent as NULL, empty strings are kept as such - COPY would read empty
+    unquoted CSV fields as NULL otherwise, unlike the row-by-row inserts.
+
+    :param cur: Cursor
+    :param df: Data to copy, columns must be ordered like columns
+    :param table: Name of target table
+    :param columns: Column names of target table
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep="\\N")
+    buffer.seek(0)
+
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV NULL '\\N'", buffer)
+
+
+def process_log_files_bulk(cur: psycopg2.extensions.cursor, filepaths: list,
+                           song_index: pd.DataFrame = None, replace: bool = False) -> list:
+    """
+    Given a connection (cursor) to a PostgreSQL database and a list of JSON-(log)-files,
+    load and combine the files, stream their time, user and songplay records into temporary
+    staging tables via COPY and merge those into the target tables with set-based upserts.
+    The upsert semantics are the same as those of process_log_file.
+
+    :param cur: Cursor
+    :param filepaths: List of paths to JSON files
+    :param song_index: Song lookup index, loaded from the database if not given
+    :param replace: If True, first delete songplays of the files' events, c.f. process_log_file
+    :return: Number of records processed per file
+    """
+    if song_index is None:
+        song_index = load_song_index(cur)
+
+    dfs = [load_log_file(f) for f in filepaths]
+    df = pd.concat(dfs, ignore_index=True)
+    df = resolve_song_ids(df, song_index)
+
+    # (re)create and clear staging tables
+    for query in stage_table_queries:
+        cur.execute(query)
+    cur.execute(stage_truncate)
+
+    # stage time, user and songplay records
+    copy_from_df(cur, make_time_df(df), "time_stage", ["ts", "hour", "day", "woy", "month", "year", "weekday"])
+    copy_from_df(cur, df[["userId", "firstName", "lastName", "gender", "level"]], "user_stage",
+                 ["user_id", "first_name", "last_name", "gender", "level"])
+    copy_from_df(cur, df[["ts", "userId", "level", "song_id", "artist_id", "sessionId", "location", "userAgent"]],
+                 "songplay_stage",
+                 ["ts", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent"])
+
+    # merge staged records into target tables
+    if replace:
+        cur.execute(songplay_stage_delete)
+    for query in merge_table_queries:
+        cur.execute(query)
+
+    return [len(e) for e in dfs]
+
+
+def get_files(filepath: str) -> list:
+    """
+    Return all *.json files found in filepath and its subdirectories.
+
+    :param filepath: Path to directory
+    :return: List of absolute file paths
+    """
+    all_files = []
+    for root, dirs, files in os.walk(filepath):
+        files = glob.glob(os.path.join(root,'*.json'))
+        for f in files :
+            all_files.append(os.path.abspath(f))
+
+    return all_files
+
+
+def file_fingerprint(filepath: str) -> tuple:
+    """
+    Return size, modification time and MD5 hash of a file's content.
+
+    :param filepath: Path to file
+    :return: Tuple of size, mtime and content hash
+    """
+    stat = os.stat(filepath)
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+
+    return stat.st_size, stat.st_mtime, md5.hexdigest()
+
+
+def filter_new_files(cur: psycopg2.extensions.cursor, files: list) -> list:
+    """
+    Drop all files from files which have already been loaded according to the manifest table.
+    Files with unchanged size and mtime are skipped right away, all others are only skipped
+    if their content hash is unchanged, i.e. modified files are loaded again. Songs, artists,
+    users and time are upserted then, songplays of reloaded events have to be replaced, c.f.
+    the replace parameter of process_log_file.
+
+    :param cur: Cursor
+    :param files: List of paths to JSON files
+    :return: List of paths to files which still have to be loaded
+    """
+    cur.execute(manifest_table_create)
+    cur.execute(manifest_select)
+    manifest = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    new_files = []
+    for f in files:
+        if f in manifest:
+            size, mtime, content_hash = manifest[f]
+            stat = os.stat(f)
+            if (stat.st_size, stat.st_mtime) == (size, mtime) or file_fingerprint(f)[2] == content_hash:
+                continue
+        new_files.append(f)
+
+    print('{} of {} files have already been loaded'.format(len(files) - len(new_files), len(files)))
+
+    return new_files
+
+
+def record_files(cur: psycopg2.extensions.cursor, files: list, counts: list):
+    """
+    Record files and their number of records in the manifest table. This should happen in the
+    same transaction in which the files' data has been inserted, so that a crashed run can be
+    resumed from the last committed file.
+
+    :param cur: Cursor
+    :param files: List of paths to JSON files
+    :param counts: Number of records per file
+    """
+    for f, count in zip(files, counts):
+        cur.execute(manifest_insert, (f, *file_fingerprint(f), count))
+
+
+def process_files(cur: psycopg2.extensions.cursor, func, files: list, batched: bool,
+                  incremental: bool = False) -> int:
+    """
+    Apply the processing function func to files, either file by file or to all files at once,
+    and optionally record them in the manifest table.
+
+    :param cur: Cursor
+    :param func: (Python) function to process data
+    :param files: List of paths to JSON files
+    :param batched: If True, func accepts a list of files (e.g. process_log_files_bulk)
+    :param incremental: If True, record processed files in the manifest table
+    :return: Number of records processed
+    """
+    if batched:
+        counts = func(cur, files)
+    else:
+        counts = [func(cur, f) for f in files]
+
+    if incremental:
+        record_files(cur, files, counts)
+
+    return sum(counts)
+
+
+def print_summary(filepath: str, num_files: int, num_records: int, start: float):
+    """
+    Print number of files and records processed as well as throughput since start.
+
+    :param filepath: Path to directory that has been processed
+    :param num_files: Number of files processed
+    :param num_records: Number of records processed
+    :param start: Start time as returned by time.perf_counter
+    """
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print('Processed {} files ({} records) from {} in {:.1f}s: {:.1f} files/s, {:.1f} records/s'.format(
+        num_files, num_records, filepath, elapsed, num_files / elapsed, num_records / elapsed))
+
 
 def process_data(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
-                 filepath: str, func):
+                 filepath: str, func, batch_size: int = None, incremental: bool = False):
     """
     Given a connection to a PostgresSQL database, a path to a directory on the
     local filesystem and a processing function, do the following:
         1. Load all *.json files found in filepath and its subdirectories
         2. Print the number of files found in step one
         3. Apply the processing function func to all files found in step one
+
+    If batch_size is given, func is called with lists of up to batch_size files
+    (e.g. process_log_files_bulk) and changes are committed once per batch.
+
+    If incremental is True, files already recorded in the manifest table are skipped
+    and processed files are recorded along with their data.
         
     :param cur: Cursor
     :param conn: Connection to PostgreSQL database
     :param filepath: Path to JSON file
     :param func: (Python) function to process data
+    :param batch_size: Number of files passed to func at once
+    :param incremental: If True, only process files not yet recorded in the manifest table
     """
+    start = time.perf_counter()
+
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    all_files = get_files(filepath)
+
+    if incremental:
+        all_files = filter_new_files(cur, all_files)
+        conn.commit()
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # iterate over batches of files (or single files) and process
+    step = batch_size or 1
+    num_records = 0
+    for i in range(0, num_files, step):
+        batch = all_files[i:i + step]
+        num_records += process_files(cur, func, batch, bool(batch_size), incremental)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        print('{}/{} files processed.'.format(i + len(batch), num_files))
+
+    print_summary(filepath, num_files, num_records, start)
+
+
+# connection and processing function of a worker process, c.f. init_worker
+_worker = {}
+
+# number of times a chunk is retried after it was chosen as deadlock victim, c.f. process_chunk
+DEADLOCK_RETRIES = 5
+
+
+def init_worker(dsn: str, func, batched: bool, incremental: bool):
+    """
+    Initialize a worker process of process_data_parallel with its own database connection.
+
+    :param dsn: Connection string of PostgreSQL database
+    :param func: (Python) function to process data
+    :param batched: If True, func accepts a list of files
+    :param incremental: If True, record processed files in the manifest table
+    """
+    conn = psycopg2.connect(dsn)
+    _worker.update(conn=conn, cur=conn.cursor(), func=func, batched=batched, incremental=incremental)
+
+
+def process_chunk(files: list) -> tuple:
+    """
+    Process a chunk of files within a worker process and commit once afterwards. Workers upsert the same
+    users and artists in different orders, so concurrent chunks may deadlock. PostgreSQL then aborts
+    one of them, whose chunk is rolled back completely (including its manifest entries) and retried.
+
+    :param files: List of paths to JSON files
+    :return: Number of files and records processed
+    """
+    for attempt in range(DEADLOCK_RETRIES + 1):
+        try:
+            num_records = process_files(_worker["cur"], _worker["func"], files, _worker["batched"],
+                                        _worker["incremental"])
+            _worker["conn"].commit()
+            return len(files), num_records
+        except psycopg2.extensions.TransactionRollbackError:
+            _worker["conn"].rollback()
+            if attempt == DEADLOCK_RETRIES:
+                raise
+            print('Deadlock while processing {}, retrying'.format(files[0]))
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def process_data_parallel(dsn: str, filepath: str, func, workers: int, batch_size: int = 10,
+                          batched: bool = False, incremental: bool = False):
+    """
+    Like process_data, but split all *.json files found in filepath into chunks of batch_size
+    files and process those in a pool of worker processes, each with its own database connection.
+    Every worker commits once per chunk. The function returns once all files have been processed.
+
+    :param dsn: Connection string of PostgreSQL database
+    :param filepath: Path to directory
+    :param func: (Python) function to process data, has to be picklable
+    :param workers: Number of worker processes
+    :param batch_size: Number of files processed per commit
+    :param batched: If True, func accepts a list of files (e.g. process_log_files_bulk)
+    :param incremental: If True, only process files not yet recorded in the manifest table
+    """
+    start = time.perf_counter()
+
+    all_files = get_files(filepath)
+
+    if incremental:
+        conn = psycopg2.connect(dsn)
+        all_files = filter_new_files(conn.cursor(), all_files)
+        conn.commit()
+        conn.close()
+
+    num_files = len(all_files)
+    print('{} files found in {}, processing them with {} workers'.format(num_files, filepath, workers))
+
+    chunks = [all_files[i:i + batch_size] for i in range(0, num_files, batch_size)]
+    done_files, num_records = 0, 0
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(dsn, func, batched, incremental)) as pool:
+        for chunk_files, chunk_records in pool.imap_unordered(process_chunk, chunks):
+            done_files += chunk_files
+            num_records += chunk_records
+            print('{}/{} files processed.'.format(done_files, num_files))
+
+    print_summary(filepath, num_files, num_records, start)
 
 
 def main():
@@ -120,11 +557,50 @@ def main():
     Connect to a PostgreSQL database and process/insert all data returned by process_data
     function.
     """
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description="Load Sparkify song and log data into PostgreSQL")
+    parser.add_argument("--bulk", action="store_true",
+                        help="load song and log files via COPY into staging tables and merge them set-based")
+    parser.add_argument("--batch-size", type=int, default=10,
+                        help="number of log files loaded per COPY/merge in bulk mode and "
+                             "number of files per commit in parallel mode")
+    parser.add_argument("--song-batch-size", type=int, default=1000,
+                        help="number of song files read and loaded per COPY/merge in bulk mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, each with its own database connection")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip files already recorded in the manifest table and record newly loaded files")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    # song files have to be loaded completely before log files are processed
+    song_func = process_song_files_bulk if args.bulk else process_song_file
+    song_batch_size = args.song_batch_size if args.bulk else args.batch_size
+
+    if args.workers > 1:
+        process_data_parallel(DSN, filepath='data/song_data', func=song_func, workers=args.workers,
+                              batch_size=song_batch_size, batched=args.bulk, incremental=args.incremental)
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=song_func,
+                     batch_size=args.song_batch_size if args.bulk else None, incremental=args.incremental)
+
+    # resolve song and artist ids in memory instead of querying them per songplay
+    song_index = load_song_index(cur)
+    print('{} songs indexed for lookup'.format(len(song_index)))
+
+    # modified log files are reloaded in incremental mode, c.f. filter_new_files
+    if args.bulk:
+        log_func = functools.partial(process_log_files_bulk, song_index=song_index, replace=args.incremental)
+    else:
+        log_func = functools.partial(process_log_file, song_index=song_index, replace=args.incremental)
+
+    if args.workers > 1:
+        process_data_parallel(DSN, filepath='data/log_data', func=log_func, workers=args.workers,
+                              batch_size=args.batch_size, batched=args.bulk, incremental=args.incremental)
+    else:
+        process_data(cur, conn, filepath='data/log_data', func=log_func,
+                     batch_size=args.batch_size if args.bulk else None, incremental=args.incremental)
 
     conn.close()
 
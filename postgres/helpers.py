@@ -1,7 +1,12 @@
+import io
 import os
+import re
 import glob
+import time
 import psycopg2
+import psycopg2.extras
 import pandas as pd
+from typing import Iterator
 
 
 def get_files(filepath: str) -> list:
@@ -28,36 +33,154 @@ def head_table(table: str, cur: psycopg2.extensions.cursor, n: int = 5):
         print(f"Error: {e}")
         
 
+def iter_records(file_list: list, columns: list = None, chunk_size: int = 100000,
+                 downcast: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Yield data from all files in file_list as dataframes of (at most) chunk_size rows,
+    so that at most one chunk (plus one file) is held in memory at a time.
+    Optionally only keep the given columns and downcast integer columns to the smallest
+    possible type - floats are kept as is to preserve exact values.
+    """
+    buffer, buffered_rows = [], 0
+
+    for f in file_list:
+        df = pd.read_json(f, orient="records", typ="frame", lines=True)
+        if columns:
+            df = df[columns].copy()
+        if downcast:
+            for col in df.select_dtypes(include="integer").columns:
+                df[col] = pd.to_numeric(df[col], downcast="integer")
+
+        buffer.append(df)
+        buffered_rows += len(df)
+
+        # emit full chunks and keep the remainder buffered
+        while buffered_rows >= chunk_size:
+            combined = pd.concat(buffer, ignore_index=True)
+            yield combined.iloc[:chunk_size]
+            buffer = [combined.iloc[chunk_size:].copy()]
+            buffered_rows -= chunk_size
+
+    if buffered_rows:
+        yield pd.concat(buffer, ignore_index=True)
+
+
+def write_records(chunks: Iterator[pd.DataFrame], file_path: str, fname: str) -> int:
+    """
+    Incrementally write chunks of data to a single CSV file (with header) on disk
+    and return the number of rows written.
+    """
+    rows = 0
+
+    with open(f"{file_path}/{fname}.csv", "w", newline="") as f:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(f, index=False, header=(i == 0))
+            rows += len(chunk)
+
+    return rows
+
+
+class RecordStream:
+    """
+    Read-only file-like object serving chunks of data as CSV text (with header),
+    which allows to COPY data into a table without materializing a CSV file first (c.f. bulk_insert).
+    """
+
+    def __init__(self, chunks: Iterator[pd.DataFrame]):
+        self._chunks = iter(chunks)
+        self._buffer = io.StringIO()
+        self._header = True
+
+    def read(self, size: int = -1) -> str:
+        # serve data from the current chunk's buffer (which keeps its own offset, instead of
+        # re-slicing the remaining text on every read) and move on to the next chunk once it is exhausted
+        parts = []
+        while size != 0:
+            data = self._buffer.read(size)
+            if data:
+                parts.append(data)
+                if size > 0:
+                    size -= len(data)
+                continue
+
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer = io.StringIO(chunk.to_csv(index=False, header=self._header))
+            self._header = False
+
+        return "".join(parts)
+
+
 def load_all_records(file_list: list, columns: list, to_disk: bool = False, file_path: str = None,
-                     fname: str = None) -> pd.DataFrame:
+                     fname: str = None, chunk_size: int = 100000, downcast: bool = False) -> pd.DataFrame:
     """
     Return a dataframe containing data (specified by columns)
     from all files in filelist and optionally save it to disk.
+    Use iter_records and write_records (or RecordStream) directly to keep memory usage bounded.
     """
-    dfs = []
-    
-    for f in file_list:
-        df = pd.read_json(f, orient="records", typ="frame", lines=True)
-        dfs.append(df[columns])
-        
-    combined_df = pd.concat(dfs)
+    dfs = list(iter_records(file_list, columns, chunk_size, downcast))
     
     if to_disk:
-        combined_df.to_csv(f"{file_path}/{fname}.csv", index=False)
+        write_records(dfs, file_path, fname)
+
+    if not dfs:
+        return pd.DataFrame(columns=columns)
     
-    return combined_df
+    return pd.concat(dfs, ignore_index=True)
+
+
+def to_tuples(data: pd.DataFrame) -> list:
+    """
+    Convert a dataframe into a list of plain tuples with Python scalars and None for missing values.
+    """
+    converted = data.astype(object).where(data.notnull(), None)
+
+    return list(converted.itertuples(index=False, name=None))
+
+
+def insert_many(query: str, rows: list, cur: psycopg2.extensions.cursor, page_size: int = 1000,
+                method: str = "values"):
+    """
+    Insert rows via a single parametrized INSERT statement, sending page_size rows per round trip.
+    With method "values" the statement's VALUES (%s, ...) clause is rewritten for
+    psycopg2.extras.execute_values (one multi-row INSERT per page), with method "batch"
+    psycopg2.extras.execute_batch is used (several statements per page).
+    Upserts (ON CONFLICT ... DO UPDATE) always use execute_batch, since a multi-row INSERT
+    must not update the same row twice.
+    """
+    if method == "values" and re.search(r"DO\s+UPDATE", query, re.IGNORECASE):
+        method = "batch"
+
+    if method == "values":
+        query = re.sub(r"VALUES\s*\((\s*%s\s*,?)+\)", "VALUES %s", query, count=1)
+        psycopg2.extras.execute_values(cur, query, rows, page_size=page_size)
+    elif method == "batch":
+        psycopg2.extras.execute_batch(cur, query, rows, page_size=page_size)
+    else:
+        raise ValueError(f"Unknown insert method: {method}")
 
 
-def drop_and_load(query_list: list, data: pd.DataFrame, cur: psycopg2.extensions.cursor):
+def drop_and_load(query_list: list, data: pd.DataFrame, cur: psycopg2.extensions.cursor,
+                  page_size: int = 1000, method: str = "values"):
     """
-    Execute all queries in query list.
+    Execute all queries in query list. INSERT statements are executed for all rows of data
+    in batches of page_size rows (c.f. insert_many) and their throughput is printed.
     """
+    rows = None
+
     for query in query_list:
         try:
-            # mind the newline character o_O
-            if query.startswith("\nINSERT"):
-                    for _, row in data.iterrows():
-                        cur.execute(query, list(row))
+            if query.lstrip().upper().startswith("INSERT"):
+                # convert data only once, even if there are several INSERT statements
+                if rows is None:
+                    rows = to_tuples(data)
+
+                table = re.search(r"INSERT\s+INTO\s+(\S+)", query, re.IGNORECASE).group(1)
+                start = time.perf_counter()
+                insert_many(query, rows, cur, page_size, method)
+                elapsed = max(time.perf_counter() - start, 1e-9)
+                print(f"Inserted {len(rows)} rows into {table} in {elapsed:.2f}s ({len(rows) / elapsed:.0f} rows/s)")
             else:
                 cur.execute(query)
 
@@ -65,12 +188,16 @@ def drop_and_load(query_list: list, data: pd.DataFrame, cur: psycopg2.extensions
             print(e)
             
 
-def bulk_insert(table: str, file_path: str, fname: str, cur: psycopg2.extensions.cursor):
+def bulk_insert(table: str, file_path: str, fname: str, cur: psycopg2.extensions.cursor, source=None):
     """
-    Insert data from a CSV file on disk into a table.
+    Insert data from a CSV file on disk into a table. If source is given, insert data from
+    this (file-like) object instead, e.g. an open pipe or a RecordStream.
     """
     try:
-        cur.execute(f"COPY {table} FROM '{file_path}/{fname}.csv' WITH CSV HEADER")
+        if source is not None:
+            cur.copy_expert(f"COPY {table} FROM STDIN WITH CSV HEADER", source)
+        else:
+            cur.execute(f"COPY {table} FROM '{file_path}/{fname}.csv' WITH CSV HEADER")
         print("Bulk insert succeeded")
     except psycopg2.Error as e:
         print(f"Bulk insert failed: {e}")           
\ No newline at end of file
@@ -4,6 +4,7 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
 song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
 artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
 
 # CREATE TABLES
 songplay_table_create = ("""
@@ -61,6 +62,20 @@ CREATE TABLE IF NOT EXISTS time (
     weekday INT)
 """)
 
+manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_manifest (
+    path VARCHAR PRIMARY KEY,
+    size BIGINT NOT NULL,
+    mtime DOUBLE PRECISION NOT NULL,
+    content_hash VARCHAR NOT NULL,
+    row_count INT,
+    loaded_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+""")
+
+# songplays of an event are looked up by session and timestamp when a log file is reloaded
+songplay_event_index_create = "CREATE INDEX IF NOT EXISTS songplay_event_idx ON songplay (session_id, ts)"
+
 # INSERT RECORDS
 songplay_table_insert = ("""
 INSERT INTO songplay (ts, user_id, level, song_id, artist_id, session_id, location, user_agent)
@@ -76,6 +91,8 @@ ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level
 song_table_insert = ("""
 INSERT INTO songs (song_id, title, artist_id, year, duration) 
 VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (song_id) DO UPDATE
+SET title = EXCLUDED.title, artist_id = EXCLUDED.artist_id, year = EXCLUDED.year, duration = EXCLUDED.duration
 """)
 
 artist_table_insert = ("""
@@ -91,6 +108,21 @@ VALUES (%s, %s, %s, %s, %s, %s, %s)
 ON CONFLICT (ts) DO NOTHING
 """)
 
+manifest_insert = ("""
+INSERT INTO etl_manifest (path, size, mtime, content_hash, row_count)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (path) DO UPDATE
+SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash,
+    row_count = EXCLUDED.row_count, loaded_at = now()
+""")
+
+# DELETE SONGPLAYS OF RELOADED EVENTS
+songplay_events_delete = ("""
+DELETE FROM songplay s
+USING unnest(%s::int[], %s::timestamp[], %s::int[]) AS e (session_id, ts, user_id)
+WHERE s.session_id = e.session_id AND s.ts = e.ts AND s.user_id = e.user_id
+""")
+
 # FIND SONGS
 song_select = ("""
 SELECT s.song_id, a.artist_id
@@ -98,10 +130,141 @@ FROM songs s JOIN artists a ON s.artist_id = a.artist_id
 WHERE s.title = %s AND a.name = %s AND s.duration = %s
 """)
 
+song_index_select = ("""
+SELECT s.title, a.name, s.duration, s.song_id, a.artist_id
+FROM songs s JOIN artists a ON s.artist_id = a.artist_id
+""")
+
+manifest_select = ("""
+SELECT path, size, mtime, content_hash
+FROM etl_manifest
+""")
+
 # QUERY LISTS
-create_table_queries = [time_table_create, artist_table_create, song_table_create, user_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [time_table_create, artist_table_create, song_table_create, user_table_create, songplay_table_create, manifest_table_create, songplay_event_index_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
 
 # QUERYS BY TABLE
 song_queries = [song_table_drop, song_table_create, song_table_insert]
 artist_queries = [artist_table_drop, artist_table_create, artist_table_insert]
+
+# STAGING TABLES (BULK LOAD)
+time_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS time_stage (
+    ts TIMESTAMP,
+    hour INT,
+    day INT,
+    woy INT,
+    month INT,
+    year INT,
+    weekday INT
+    )
+""")
+
+user_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS user_stage (
+    seq SERIAL,
+    user_id INT,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    gender VARCHAR,
+    level VARCHAR
+    )
+""")
+
+songplay_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplay_stage (
+    seq SERIAL,
+    ts TIMESTAMP,
+    user_id INT,
+    level VARCHAR,
+    song_id VARCHAR,
+    artist_id VARCHAR,
+    session_id INT,
+    location VARCHAR,
+    user_agent VARCHAR
+    )
+""")
+
+song_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS song_stage (
+    seq SERIAL,
+    song_id VARCHAR,
+    title VARCHAR,
+    artist_id VARCHAR,
+    year INT,
+    duration FLOAT
+    )
+""")
+
+artist_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS artist_stage (
+    seq SERIAL,
+    artist_id VARCHAR,
+    name VARCHAR,
+    location VARCHAR,
+    latitude FLOAT,
+    longitude FLOAT
+    )
+""")
+
+stage_truncate = "TRUNCATE time_stage, user_stage, songplay_stage"
+song_stage_truncate = "TRUNCATE song_stage, artist_stage"
+
+# MERGE STAGED RECORDS
+# same semantics as time_table_insert: first timestamp wins
+time_table_merge = ("""
+INSERT INTO time (ts, hour, day, woy, month, year, weekday)
+SELECT ts, hour, day, woy, month, year, weekday
+FROM time_stage
+ON CONFLICT (ts) DO NOTHING
+""")
+
+# same semantics as user_table_insert: last level seen for a user wins
+user_table_merge = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level
+FROM user_stage
+ORDER BY user_id, seq DESC
+ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level
+""")
+
+# same semantics as song_table_insert: last record of a song wins
+song_table_merge = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+SELECT DISTINCT ON (song_id) song_id, title, artist_id, year, duration
+FROM song_stage
+ORDER BY song_id, seq DESC
+ON CONFLICT (song_id) DO UPDATE
+SET title = EXCLUDED.title, artist_id = EXCLUDED.artist_id, year = EXCLUDED.year, duration = EXCLUDED.duration
+""")
+
+# same semantics as artist_table_insert: last record of an artist wins
+artist_table_merge = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+SELECT DISTINCT ON (artist_id) artist_id, name, location, latitude, longitude
+FROM artist_stage
+ORDER BY artist_id, seq DESC
+ON CONFLICT (artist_id) DO UPDATE
+SET location = EXCLUDED.location, latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude
+""")
+
+# same semantics as songplay_events_delete
+songplay_stage_delete = ("""
+DELETE FROM songplay s
+USING songplay_stage e
+WHERE s.session_id = e.session_id AND s.ts = e.ts AND s.user_id = e.user_id
+""")
+
+songplay_table_merge = ("""
+INSERT INTO songplay (ts, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT ts, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplay_stage
+ORDER BY seq
+""")
+
+# QUERY LISTS (BULK LOAD)
+stage_table_queries = [time_stage_create, user_stage_create, songplay_stage_create]
+merge_table_queries = [time_table_merge, user_table_merge, songplay_table_merge]
+song_stage_table_queries = [song_stage_create, artist_stage_create]
+song_merge_table_queries = [artist_table_merge, song_table_merge]
@@ -1,6 +1,22 @@
+import re
+import json
+import time
+import argparse
 import configparser
+import boto3
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from datetime import timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from sql_queries import copy_table_queries, insert_table_queries, insert_table_incremental_queries
+from sql_queries import copy_manifest_queries
+from sql_queries import load_state_lock, load_state_select, load_state_keys_select, load_state_prune, load_state_insert
+
+# objects may be listed with a last modified timestamp older than that of objects loaded before (e.g. multipart
+# uploads are dated by their start), so objects up to this lag before the latest loaded one are listed again and
+# filtered by the keys recorded in load_state
+LATE_OBJECT_LAG = timedelta(hours=1)
 
 
 def load_staging_tables(cur, conn):
@@ -14,29 +30,273 @@ def load_staging_tables(cur, conn):
         conn.commit()
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, queries: list = insert_table_queries):
     """
     Load data into fact and dimension tables as specified by SQL statements in insert_table_queries list
     :param cur: psycopg2 cursor
     :param conn: psycopg2 connection
+    :param queries: List of SQL statements, e.g. insert_table_incremental_queries
     """
-    for query in insert_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
+def parse_s3_url(url: str) -> tuple:
+    """
+    Split an S3 URL into bucket and key.
+    :param url: S3 URL, e.g. s3://udacity-dend/log_data
+    :return: Tuple of bucket and key
+    """
+    bucket, _, key = url.replace("s3://", "", 1).partition("/")
+    return bucket, key
+
+
+def list_new_objects(s3, url: str, since=None, loaded: set = frozenset()) -> list:
+    """
+    List the objects below an S3 prefix which have not been loaded yet, i.e. which have been modified at or after
+    since and whose keys are not among the loaded ones.
+    :param s3: boto3 S3 client
+    :param url: S3 URL of prefix
+    :param since: Last modified timestamp (UTC) to list objects from, None to list all objects
+    :param loaded: Keys of objects modified at or after since which have already been loaded
+    :return: List of tuples of last modified, key and size, ordered by last modified and key
+    """
+    bucket, prefix = parse_s3_url(url)
+
+    objects = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/") or not obj["Size"]:
+                continue
+            last_modified = obj["LastModified"].astimezone(timezone.utc).replace(tzinfo=None)
+            if (since is None or last_modified >= since) and obj["Key"] not in loaded:
+                objects.append((last_modified, obj["Key"], obj["Size"]))
+
+    return sorted(objects)
+
+
+def write_manifest(s3, bucket: str, objects: list, manifest_url: str) -> str:
+    """
+    Write a COPY manifest listing the given objects to S3.
+    :param s3: boto3 S3 client
+    :param bucket: Bucket of objects
+    :param objects: List of tuples of last modified, key and size as returned by list_new_objects
+    :param manifest_url: S3 URL to write manifest to
+    :return: manifest_url
+    """
+    manifest = {"entries": [{"url": f"s3://{bucket}/{key}", "mandatory": True, "meta": {"content_length": size}}
+                            for _, key, size in objects]}
+
+    manifest_bucket, manifest_key = parse_s3_url(manifest_url)
+    s3.put_object(Bucket=manifest_bucket, Key=manifest_key, Body=json.dumps(manifest).encode("utf-8"))
+    return manifest_url
+
+
+def get_load_state(cur, table: str, source: str, lag: timedelta = LATE_OBJECT_LAG) -> tuple:
+    """
+    Lock the load_state table until the end of the transaction and return from when on objects of a source have to
+    be listed, i.e. lag before the last modified timestamp of the latest object loaded into a table, along with the
+    keys of the objects loaded since then.
+    :param cur: psycopg2 cursor
+    :param table: Name of staging table
+    :param source: S3 URL of source prefix
+    :param lag: Time objects may show up late in listings, c.f. LATE_OBJECT_LAG
+    :return: Tuple of last modified timestamp (UTC), None if nothing has been loaded yet, and set of loaded keys
+    """
+    cur.execute(load_state_lock)
+    cur.execute(load_state_select, (table, source))
+    latest = cur.fetchone()[0]
+    if latest is None:
+        return None, set()
+
+    since = latest - lag
+    cur.execute(load_state_keys_select, (table, source, since))
+    return since, {key for key, in cur.fetchall()}
+
+
+def load_staging_table_incremental(cur, conn, s3, table: str, manifest_path: str,
+                                   lag: timedelta = LATE_OBJECT_LAG) -> int:
+    """
+    Load only those objects into a staging table which have been added to its S3 source since the last successful
+    load: new objects are listed in a manifest and loaded via COPY ... MANIFEST. Reading the load state, clearing the
+    staging table, COPY and recording the loaded objects run in one transaction holding a lock on load_state, so a
+    failed load is simply retried by the next run and concurrent runs wait for each other instead of loading the
+    same objects. Only objects within lag of the latest loaded one are kept in load_state, c.f. get_load_state.
+    Without new objects the staging table is cleared nevertheless, so that its rows are not inserted twice.
+    :param cur: psycopg2 cursor
+    :param conn: psycopg2 connection
+    :param s3: boto3 S3 client
+    :param table: Name of staging table, c.f. copy_manifest_queries
+    :param manifest_path: S3 URL of prefix to write manifests to
+    :param lag: Time objects may show up late in listings, c.f. LATE_OBJECT_LAG
+    :return: Number of loaded objects
+    """
+    source, clear_query, copy_query = copy_manifest_queries[table]
+
+    try:
+        since, loaded = get_load_state(cur, table, source, lag)
+        objects = list_new_objects(s3, source, since, loaded)
+        if not objects:
+            # clear rows of the previous load anyway, the inserts would load them again otherwise
+            cur.execute(clear_query)
+            conn.commit()
+            print('No new objects for {} since {}'.format(table, since or 'the beginning'))
+            return 0
+
+        manifest_url = "{}/{}/{}.manifest".format(manifest_path.rstrip("/"), table, time.strftime("%Y%m%dT%H%M%S"))
+        write_manifest(s3, parse_s3_url(source)[0], objects, manifest_url)
+
+        keep_since = max([objects[-1][0]] + ([since + lag] if since else [])) - lag
+        cur.execute(clear_query)
+        cur.execute(copy_query.format(manifest_url))
+        cur.execute(load_state_prune, (table, source, keep_since))
+        execute_values(cur, load_state_insert, [(table, source, key, last_modified)
+                                                for last_modified, key, _ in objects if last_modified >= keep_since])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print('Loaded {} new objects into {} via {}'.format(len(objects), table, manifest_url))
+    return len(objects)
+
+
+def parse_tables(query: str) -> tuple:
+    """
+    Extract the table a COPY, INSERT or DELETE statement writes to and the tables it reads from. For several
+    statements run as one (e.g. a DELETE followed by an INSERT), the first one determines the target.
+    :param query: SQL statement(s)
+    :return: Tuple of target table and set of source tables (may contain aliases or columns, e.g. of EXTRACT)
+    """
+    target = re.search(r"^\s*(?:COPY|INSERT\s+INTO|DELETE\s+FROM)\s+(\w+)", query, re.IGNORECASE).group(1).lower()
+    sources = {table.lower() for table in re.findall(r"\b(?:FROM|JOIN|USING)\s+(\w+)", query, re.IGNORECASE)}
+    return target, sources - {target}
+
+
+def build_graph(queries: list) -> dict:
+    """
+    Build the dependency graph of a list of statements: a statement depends on all statements writing to a table it
+    reads from, and on earlier statements writing to the same table.
+    :param queries: List of SQL statements
+    :return: Dictionary mapping the index of each statement to the set of indexes of statements it depends on
+    """
+    tables = [parse_tables(query) for query in queries]
+
+    graph = {}
+    for i, (target, sources) in enumerate(tables):
+        graph[i] = {j for j, (other, _) in enumerate(tables)
+                    if j != i and (other in sources or (other == target and j < i))}
+
+    return graph
+
+
+def run_query(pool: ThreadedConnectionPool, query: str) -> tuple:
+    """
+    Execute and commit a statement on a connection of the pool.
+    :param pool: psycopg2 connection pool
+    :param query: SQL statement
+    :return: Tuple of duration in seconds and number of rows affected
+    """
+    conn = pool.getconn()
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(query)
+            rows = cur.rowcount
+        conn.commit()
+        return time.perf_counter() - start, rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def run_parallel(pool: ThreadedConnectionPool, queries: list, workers: int = 4) -> list:
+    """
+    Run statements concurrently, each as soon as all statements it depends on (c.f. build_graph) have finished.
+    Once a statement fails, no further statements are started and the error is raised after running statements
+    have finished.
+    :param pool: psycopg2 connection pool with at least workers connections
+    :param queries: List of SQL statements
+    :param workers: Maximum number of statements run at the same time
+    :return: List of dictionaries with table, duration in seconds and rows affected per statement, in order of
+    completion
+    """
+    graph = build_graph(queries)
+    done, running, stats = set(), {}, []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(done) < len(queries):
+            for i in sorted(graph):
+                if i not in done and i not in running.values() and graph[i] <= done:
+                    running[executor.submit(run_query, pool, queries[i])] = i
+
+            if not running:
+                raise ValueError("Cyclic dependencies between statements {}".format(set(graph) - done))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                try:
+                    seconds, rows = future.result()
+                except Exception:
+                    wait(running)
+                    raise
+                done.add(i)
+                stats.append({"table": parse_tables(queries[i])[0], "seconds": seconds, "rows": rows})
+                print('Loaded {:<16} {:>10} rows {:>8.1f}s'.format(stats[-1]["table"], rows, seconds))
+
+    return stats
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Load Sparkify data from S3 into Redshift")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of statements run at the same time, each on its own connection")
+    parser.add_argument("--incremental", action="store_true",
+                        help="stage only S3 objects added since the last load via COPY manifests")
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+    copy_queries = copy_table_queries
+    if args.incremental:
+        # ENDPOINT_URL allows to point boto3 to a local S3 stand-in like minio for testing
+        s3 = boto3.client("s3", endpoint_url=config.get("S3", "ENDPOINT_URL", fallback=None) or None)
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        for table in copy_manifest_queries:
+            load_staging_table_incremental(cur, conn, s3, table, config.get("S3", "MANIFEST_PATH"))
+        conn.close()
+        copy_queries = []
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    # staging tables only hold new data in incremental mode, which has to be merged into existing rows
+    insert_queries = insert_table_incremental_queries if args.incremental else insert_table_queries
+
+    if args.workers > 1:
+        pool = ThreadedConnectionPool(1, args.workers, dsn)
+        try:
+            start = time.perf_counter()
+            stats = run_parallel(pool, copy_queries + insert_queries, args.workers)
+            print('Loaded {} tables in {:.1f}s (sum of statements {:.1f}s)'.format(
+                len(stats), time.perf_counter() - start, sum(s["seconds"] for s in stats)))
+        finally:
+            pool.closeall()
+        return
+
+    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+
+    if not args.incremental:
+        load_staging_tables(cur, conn)
+    insert_tables(cur, conn, insert_queries)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -13,6 +13,7 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
 song_table_drop = "DROP TABLE IF EXISTS song CASCADE"
 artist_table_drop = "DROP TABLE IF EXISTS artist CASCADE"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+load_state_table_drop = "DROP TABLE IF EXISTS load_state CASCADE"
 
 # CREATE TABLES
 staging_events_table_create= ("""
@@ -108,6 +109,16 @@ CREATE TABLE IF NOT EXISTS time (
     )
 """)
 
+load_state_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_state (
+    table_name VARCHAR NOT NULL,
+    source VARCHAR(1024) NOT NULL,
+    object_key VARCHAR(1024) NOT NULL,
+    last_modified TIMESTAMP NOT NULL,
+    loaded_at TIMESTAMP DEFAULT GETDATE()
+    )
+""")
+
 # STAGING TABLES
 staging_events_copy = ("""
 COPY staging_events FROM '{}'
@@ -125,6 +136,55 @@ COMPUPDATE OFF STATUPDATE OFF
 JSON 'auto' TRUNCATECOLUMNS
 """).format(config.get("S3", "SONG_DATA"), config.get("IAM_ROLE", "ARN"))
 
+# INCREMENTAL STAGING
+# the manifest listing the S3 objects to load is filled in at runtime
+staging_events_copy_manifest = ("""
+COPY staging_events FROM '{{}}'
+CREDENTIALS 'aws_iam_role={}'
+REGION 'us-west-2'
+COMPUPDATE OFF
+JSON '{}'
+MANIFEST
+""").format(config.get("IAM_ROLE", "ARN"), config.get("S3", "LOG_JSONPATH"))
+
+staging_songs_copy_manifest = ("""
+COPY staging_songs FROM '{{}}'
+CREDENTIALS 'aws_iam_role={}'
+REGION 'us-west-2'
+COMPUPDATE OFF STATUPDATE OFF
+JSON 'auto' TRUNCATECOLUMNS
+MANIFEST
+""").format(config.get("IAM_ROLE", "ARN"))
+
+staging_events_clear = "DELETE FROM staging_events"
+staging_songs_clear = "DELETE FROM staging_songs"
+
+# serializes incremental loads, so that concurrent runs do not stage the same objects
+load_state_lock = "LOCK load_state"
+
+load_state_select = ("""
+SELECT MAX(last_modified)
+FROM load_state
+WHERE table_name = %s AND source = %s
+""")
+
+load_state_keys_select = ("""
+SELECT object_key
+FROM load_state
+WHERE table_name = %s AND source = %s AND last_modified >= %s
+""")
+
+load_state_prune = ("""
+DELETE FROM load_state
+WHERE table_name = %s AND source = %s AND last_modified < %s
+""")
+
+# rows are passed as a single multi-row VALUES list, c.f. psycopg2.extras.execute_values
+load_state_insert = ("""
+INSERT INTO load_state (table_name, source, object_key, last_modified)
+VALUES %s
+""")
+
 # FINAL TABLES
 songplay_table_insert = ("""
 INSERT INTO songplay (ts, user_id, level, song_id, artist_id, session_id, location, user_agent)
@@ -185,8 +245,110 @@ SELECT  valid_ts,
             ) stg_events
 """)
 
+# FINAL TABLES (INCREMENTAL)
+# staging tables only hold new data, which has to be merged into the tables loaded before
+user_table_delete_incremental = ("""
+DELETE FROM users
+USING staging_events
+WHERE users.user_id = staging_events.user_id
+""")
+
+# the latest level of a user wins, c.f. user_table_merge_incremental
+user_table_insert_incremental = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+FROM (
+    SELECT user_id, first_name, last_name, gender, level,
+           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS rn
+    FROM staging_events
+    WHERE user_id IS NOT NULL
+    ) latest
+WHERE rn = 1
+""")
+
+# deleting and inserting users has to happen in one transaction, so both statements are run as one
+user_table_merge_incremental = user_table_delete_incremental.rstrip() + ";" + user_table_insert_incremental
+
+song_table_insert_incremental = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+SELECT song_id, title, artist_id, year, duration
+FROM (
+    SELECT song_id, title, artist_id, year, duration,
+           ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS rn
+    FROM staging_songs
+    ) new_songs
+WHERE rn = 1 AND NOT EXISTS (SELECT 1 FROM songs s WHERE s.song_id = new_songs.song_id)
+""")
+
+artist_table_insert_incremental = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+FROM (
+    SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+           ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS rn
+    FROM staging_songs
+    ) new_artists
+WHERE rn = 1 AND NOT EXISTS (SELECT 1 FROM artists a WHERE a.artist_id = new_artists.artist_id)
+""")
+
+time_table_insert_incremental = ("""
+INSERT INTO time (ts, hour, day, woy, month, year, weekday)
+SELECT  valid_ts,
+        EXTRACT(hour FROM  valid_ts) AS valid_hour,
+        EXTRACT(day FROM valid_ts) AS valid_day,
+        EXTRACT(week FROM valid_ts) AS valid_woy,
+        EXTRACT(month FROM valid_ts) AS valid_month,
+        EXTRACT(year FROM valid_ts) AS valid_year,
+        EXTRACT(dow FROM valid_ts) AS valid_weekday
+        FROM (
+            SELECT DISTINCT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS valid_ts
+            FROM staging_events
+            ) stg_events
+        WHERE NOT EXISTS (SELECT 1 FROM time t WHERE t.ts = stg_events.valid_ts)
+""")
+
+# events which have been loaded before (e.g. by a run that failed afterwards) are skipped
+songplay_table_insert_incremental = ("""
+INSERT INTO songplay (ts, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT TIMESTAMP 'epoch' + se.ts/1000 * interval '1 second' AS valid_ts,
+       se.user_id,
+       se.level,
+       sa.song_id,
+       sa.artist_id,
+       se.session_id,
+       se.location,
+       se.user_agent
+FROM staging_events se
+JOIN (
+    SELECT s.song_id, a.artist_id, s.title, a.name, s.duration
+    FROM songs s
+    JOIN artists a
+    ON s.artist_id = a.artist_id
+    ) AS sa
+ON (
+    sa.title = se.song
+    AND sa.name = se.artist
+    AND sa.duration = se.length
+    )
+WHERE se.page = 'NextSong'
+AND NOT EXISTS (
+    SELECT 1
+    FROM songplay sp
+    WHERE sp.session_id = se.session_id
+    AND sp.ts = TIMESTAMP 'epoch' + se.ts/1000 * interval '1 second'
+    AND sp.user_id = se.user_id
+    )
+""")
+
 # QUERY LISTS
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, load_state_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop, load_state_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
\ No newline at end of file
+copy_manifest_queries = {
+    "staging_events": (config.get("S3", "LOG_DATA"), staging_events_clear, staging_events_copy_manifest),
+    "staging_songs": (config.get("S3", "SONG_DATA"), staging_songs_clear, staging_songs_copy_manifest)
+}
+insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
+insert_table_incremental_queries = [user_table_merge_incremental, song_table_insert_incremental,
+                                    artist_table_insert_incremental, time_table_insert_incremental,
+                                    songplay_table_insert_incremental]
\ No newline at end of file
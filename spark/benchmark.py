@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import time
+from pyspark.sql import SparkSession
+from etl import process_song_data, process_log_data, get_storage_level, count_files, TABLE_LAYOUTS
+from generate_data import generate
+from metrics import StageMetrics
+
+
+def create_local_spark_session(master: str = "local[*]") -> SparkSession:
+    """
+    Create a Spark session running locally, without Hadoop-AWS JARs, converting timestamps in UTC like etl.py.
+    :param master: Spark master URL
+    :return: SparkSession
+    """
+    return SparkSession \
+        .builder \
+        .master(master) \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .appName("Sparkify ETL benchmark") \
+        .getOrCreate()
+
+
+def benchmark(spark: SparkSession, input_data: str, output_data: str, storage_level=None) -> dict:
+    """
+    Run song and log stages on input_data and collect metrics per stage (c.f. StageMetrics) and output file counts.
+    :param spark: SparkSession
+    :param input_data: Path to input data, c.f. generate_data.py
+    :param output_data: Path to store output data
+    :param storage_level: StorageLevel to persist intermediates at, None to disable caching
+    :return: Report
+    """
+    metrics = StageMetrics(spark)
+
+    print("Start processing song data")
+    songs_table, artists_table = process_song_data(spark, input_data, output_data, storage_level=storage_level,
+                                                   timings=metrics)
+
+    print("Start processing log data")
+    process_log_data(spark, input_data, output_data, songs_table=songs_table, artists_table=artists_table,
+                     storage_level=storage_level, timings=metrics)
+
+    for table in (songs_table, artists_table):
+        if table is not None:
+            table.unpersist()
+
+    report = {"stages": metrics.records, "tables": {}}
+    for table in TABLE_LAYOUTS:
+        files, size = count_files(spark, f"{output_data}/{table}/")
+        report["tables"][table] = {"files": files, "bytes": size}
+
+    metrics.print_summary()
+    return report
+
+
+def main():
+    """
+    Run the ETL pipeline in local mode on synthetic data and write a JSON report, so that changes can be compared
+    before they are deployed to the cluster.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark spark/etl.py in local mode")
+    parser.add_argument("--input", default="data/synthetic", help="path to synthetic input data")
+    parser.add_argument("--output", default="data/benchmark", help="path to store output data")
+    parser.add_argument("--events", type=int, default=10000, help="number of events to generate if input is missing")
+    parser.add_argument("--master", default="local[*]", help="Spark master URL")
+    parser.add_argument("--storage-level", default="MEMORY_AND_DISK", help="storage level of intermediates or NONE")
+    parser.add_argument("--report", default="benchmark.json", help="path to write the JSON report to")
+    args = parser.parse_args()
+
+    input_data = os.path.abspath(args.input)
+    output_data = os.path.abspath(args.output)
+
+    if not os.path.exists(input_data):
+        print(f"Generating synthetic data in {input_data}")
+        generate(input_data, args.events)
+
+    print("Creating Spark Session")
+    spark = create_local_spark_session(args.master)
+
+    report = benchmark(spark, input_data, output_data, get_storage_level(args.storage_level))
+    report.update(input=input_data, master=args.master, storage_level=args.storage_level,
+                  started=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Report written to {args.report}")
+
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
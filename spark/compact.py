@@ -0,0 +1,197 @@
+import configparser
+import math
+import os
+import posixpath
+import time
+from urllib.parse import urlparse
+from pyspark.sql import SparkSession, DataFrame
+from pyspark.sql.functions import broadcast, expr
+from etl import create_spark_session, get_fs, read_json, song_schema, log_schema
+
+
+# glob patterns of raw files and schemas by dataset
+DATASETS = {
+    "song_data": ("song_data/*/*/*/*.json", song_schema),
+    "log_data": ("log_data/*/*/*.json", log_schema)
+}
+
+# maximum number of files passed to Spark one by one, Spark 2.4 checks each of them serially on the driver
+MAX_EXPLICIT_FILES = 1000
+
+# column holding the raw file of a record, c.f. select_new_files
+INPUT_FILE = "_input_file"
+
+
+def list_files(spark: SparkSession, pattern: str) -> dict:
+    """
+    List all files matching a glob pattern.
+    :param spark: SparkSession
+    :param pattern: Glob pattern
+    :return: Dictionary mapping file paths to their size in bytes
+    """
+    fs, path = get_fs(spark, pattern)
+    statuses = fs.globStatus(path) or []
+    return {str(status.getPath()): status.getLen() for status in statuses if status.isFile()}
+
+
+def input_paths(pattern: str, raw_files: dict, new_files: dict, max_files: int = MAX_EXPLICIT_FILES) -> list:
+    """
+    Return paths or glob patterns covering all new files with few entries: the dataset's pattern if everything is
+    new or too many files are new, otherwise a pattern per directory whose files are all new and the remaining new
+    files one by one. Patterns may also match files which have not been listed, c.f. select_new_files.
+    :param pattern: Glob pattern of all raw files of the dataset
+    :param raw_files: Dictionary of all raw files as returned by list_files
+    :param new_files: Dictionary of raw files which have not been compacted yet
+    :param max_files: Maximum number of files to pass one by one
+    :return: List of paths and glob patterns
+    """
+    if len(new_files) == len(raw_files) or len(new_files) > max_files:
+        return [pattern]
+
+    directories = {}
+    for path in raw_files:
+        directories.setdefault(posixpath.dirname(path), []).append(path)
+
+    paths = []
+    for directory, files in sorted(directories.items()):
+        new = [path for path in files if path in new_files]
+        if len(new) == len(files):
+            paths.append(f"{directory}/*.json")
+        else:
+            paths.extend(new)
+
+    return paths
+
+
+def select_new_files(spark: SparkSession, df: DataFrame, new_files: dict) -> DataFrame:
+    """
+    Keep only records of listed new files, dropping those of files which have been added after listing but match
+    a glob pattern read. They are not recorded in the manifest of the batch, so they are left for the next run.
+    Paths are compared without scheme and authority, which Spark and Hadoop format differently for local files.
+    :param spark: SparkSession
+    :param df: DataFrame read by read_json with file_column=INPUT_FILE
+    :param new_files: Dictionary of raw files which have not been compacted yet
+    :return: DataFrame without INPUT_FILE column
+    """
+    listed = spark.createDataFrame([(urlparse(path).path,) for path in new_files], [INPUT_FILE])
+    return df.withColumn(INPUT_FILE, expr(f"parse_url({INPUT_FILE}, 'PATH')")) \
+        .join(broadcast(listed), INPUT_FILE, "left_semi") \
+        .drop(INPUT_FILE)
+
+
+def read_manifest(spark: SparkSession, output_path: str) -> tuple:
+    """
+    Read the manifest of a compacted dataset, i.e. the raw files contained in each committed batch.
+    :param spark: SparkSession
+    :param output_path: Path of compacted dataset
+    :return: Tuple of the set of compacted raw files and the set of committed batch ids
+    """
+    fs, path = get_fs(spark, f"{output_path}/_manifest")
+    if not fs.exists(path):
+        return set(), set()
+
+    manifest = spark.read.json(f"{output_path}/_manifest/*").collect()
+    return {row.path for row in manifest}, {row.batch for row in manifest}
+
+
+def remove_uncommitted(spark: SparkSession, output_path: str, committed: set) -> None:
+    """
+    Delete batches of compacted data without a manifest entry, i.e. leftovers of a failed run.
+    :param spark: SparkSession
+    :param output_path: Path of compacted dataset
+    :param committed: Set of committed batch ids
+    :return: None
+    """
+    fs, path = get_fs(spark, f"{output_path}/data")
+    if not fs.exists(path):
+        return
+
+    for status in fs.listStatus(path):
+        if status.getPath().getName() not in committed:
+            print(f"Removing uncommitted batch {status.getPath()}")
+            fs.delete(status.getPath(), True)
+
+
+def compact(spark: SparkSession, input_data: str, compacted_data: str, dataset: str, fmt: str = "parquet",
+            target_file_size: int = 128 * 1024 ** 2, quarantine_data: str = None) -> int:
+    """
+    Merge raw small JSON files of a dataset (song_data or log_data) into few large Parquet or line-delimited JSON
+    files of about target_file_size bytes. Only raw files which have not been compacted yet are processed. Each run
+    writes a new batch to {compacted_data}/{dataset}/data/<batch> and commits it by writing the batch's raw files to
+    {compacted_data}/{dataset}/_manifest/<batch> afterwards, so reruns after failures neither lose nor duplicate data.
+    :param spark: SparkSession
+    :param input_data: Path to input data
+    :param compacted_data: Path to store compacted data
+    :param dataset: Name of dataset, c.f. DATASETS
+    :param fmt: Output format, i.e. parquet or json
+    :param target_file_size: Target size of output files in bytes (measured on raw input)
+    :param quarantine_data: Path to store malformed records
+    :return: Number of compacted raw files
+    """
+    pattern, schema = DATASETS[dataset]
+    output_path = f"{compacted_data}/{dataset}"
+
+    compacted_files, committed = read_manifest(spark, output_path)
+    remove_uncommitted(spark, output_path, committed)
+
+    # determine raw files which have not been compacted yet
+    raw_files = list_files(spark, f"{input_data}/{pattern}")
+    new_files = {path: size for path, size in raw_files.items() if path not in compacted_files}
+    print(f"{len(new_files)} of {len(raw_files)} {dataset} files have not been compacted yet")
+
+    if not new_files:
+        return 0
+
+    # size output files by the amount of raw input
+    num_files = max(1, math.ceil(sum(new_files.values()) / target_file_size))
+    batch = time.strftime("%Y%m%d%H%M%S")
+
+    # read by glob patterns where possible, listing hundreds of thousands of files one by one is slow
+    paths = input_paths(f"{input_data}/{pattern}", raw_files, new_files)
+    globbed = any(path not in new_files for path in paths)
+    df, raw = read_json(spark, paths, schema,
+                        quarantine_path=f"{quarantine_data}/{dataset}" if quarantine_data else None,
+                        file_column=INPUT_FILE if globbed else None)
+    if globbed:
+        df = select_new_files(spark, df, new_files)
+
+    print(f"Compacting {len(new_files)} {dataset} files into {num_files} {fmt} files")
+    df.repartition(num_files).write.format(fmt).save(f"{output_path}/data/{batch}")
+    if raw is not None:
+        raw.unpersist()
+
+    # commit batch
+    spark.createDataFrame([(path, batch) for path in new_files], ["path", "batch"]) \
+        .coalesce(1) \
+        .write.json(f"{output_path}/_manifest/{batch}")
+
+    return len(new_files)
+
+
+def main():
+    # load config
+    config = configparser.ConfigParser()
+    config.read('dl.cfg')
+
+    # define environment variables for AWS EMR
+    os.environ['AWS_ACCESS_KEY_ID'] = config.get("AWS", "AWS_ACCESS_KEY_ID")
+    os.environ['AWS_SECRET_ACCESS_KEY'] = config.get("AWS", "AWS_SECRET_ACCESS_KEY")
+
+    input_data = config.get("ETL", "INPUT_DATA")
+    compacted_data = config.get("ETL", "COMPACTED_DATA")
+    fmt = config.get("ETL", "COMPACTED_FORMAT", fallback="parquet")
+    target_file_size = config.getint("ETL", "COMPACTED_FILE_SIZE_MB", fallback=128) * 1024 ** 2
+    quarantine_data = config.get("ETL", "QUARANTINE_DATA", fallback=None) or None
+
+    print("Creating Spark Session")
+    spark = create_spark_session(config.get("EMR", "SPARK_JARS"))
+
+    for dataset in DATASETS:
+        print(f"Start compacting {dataset}")
+        compact(spark, input_data, compacted_data, dataset, fmt, target_file_size, quarantine_data)
+
+    print("Finished compaction")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,663 @@
 import configparser
+import json
 import os
 import sys
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import from_unixtime
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, DataFrame, Window
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType
+from pyspark.sql.functions import col, from_unixtime, lower, trim, broadcast, lit, row_number
+from pyspark.sql.functions import input_file_name
+from pyspark.sql.functions import max as max_
+from pyspark.sql.functions import abs as abs_
+from pyspark.sql.functions import hash as hash_
+from pyspark.sql.functions import round as round_
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek
-from pyspark.sql.functions import monotonically_increasing_id
+from pyspark.sql.functions import md5, concat_ws
+from metrics import StageMetrics
+
+
+# column holding the raw text of records which do not match the schema
+CORRUPT_RECORD = "_corrupt_record"
+
+# explicit schemas of song and log records, c.f. read_json
+song_schema = StructType([
+    StructField("num_songs", LongType()),
+    StructField("artist_id", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_name", StringType()),
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("duration", DoubleType()),
+    StructField("year", LongType()),
+    StructField(CORRUPT_RECORD, StringType())
+])
+
+log_schema = StructType([
+    StructField("artist", StringType()),
+    StructField("auth", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("itemInSession", LongType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("method", StringType()),
+    StructField("page", StringType()),
+    StructField("registration", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("status", LongType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType()),
+    StructField(CORRUPT_RECORD, StringType())
+])
+
+# default output layout of a table, c.f. write_table
+DEFAULT_LAYOUT = {
+    "partition_by": [],             # partition columns
+    "repartition": True,            # repartition by partition columns, i.e. one file per partition instead of per task
+    "files_per_partition": 1,       # spread each partition over this many tasks/files to cope with skewed partitions
+    "max_records_per_file": 0,      # maximum number of records per file, 0 for unlimited
+    "sort_by": [],                  # columns to sort records by within each file, e.g. join keys
+    "bucket_by": [],                # bucket columns, requires saving the table to the catalog
+    "num_buckets": 0                # number of buckets
+}
+
+# output layout per table, can be overridden in the LAYOUT section of dl.cfg, c.f. get_layouts
+TABLE_LAYOUTS = {
+    "songs": dict(DEFAULT_LAYOUT, partition_by=["year", "artist_id"]),
+    "artists": dict(DEFAULT_LAYOUT),
+    "users": dict(DEFAULT_LAYOUT),
+    "time": dict(DEFAULT_LAYOUT, partition_by=["year", "month"]),
+    "songplays": dict(DEFAULT_LAYOUT, partition_by=["year", "month"])
+}
 
 
 def create_spark_session(spark_jars: str) -> SparkSession:
     """
-    Create Spark session
+    Create Spark session. Timestamps are converted in UTC, so that year/month partitions match the ingestion
+    watermark (c.f. month_start) regardless of the time zone of the cluster.
     :param spark_jars: Hadoop-AWS JARs
     :return: SparkSession
     """
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", spark_jars) \
+        .config("spark.sql.session.timeZone", "UTC") \
         .appName("Sparkify ETL") \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark: SparkSession, input_data: str, output_data: str) -> None:
+def read_json(spark: SparkSession, path, schema: StructType, infer_schema: bool = False,
+              quarantine_path: str = None, file_column: str = None) -> tuple:
+    """
+    Read JSON data in a single pass using an explicit schema instead of letting Spark scan all files to infer it.
+    Records not matching the schema are dropped and, if a quarantine path is given, their raw text is appended to
+    it for later inspection. Quarantining requires caching the raw data, which is returned as well, so that the
+    caller can unpersist it once the valid records have been consumed.
+    :param spark: SparkSession
+    :param path: Path to JSON data or list of paths
+    :param schema: Schema of JSON records, including a string column named CORRUPT_RECORD
+    :param infer_schema: If True, ignore schema and infer it from the data (two passes)
+    :param quarantine_path: Path to store malformed records
+    :param file_column: If given, add a column of this name holding the file each record has been read from
+    :return: Tuple of DataFrame of valid records and cached raw DataFrame (None unless quarantining)
+    """
+    if infer_schema:
+        return spark.read.json(path), None
+
+    df = spark.read \
+        .schema(schema) \
+        .option("mode", "PERMISSIVE") \
+        .option("columnNameOfCorruptRecord", CORRUPT_RECORD) \
+        .json(path)
+
+    if file_column:
+        # has to be evaluated on the file scan, i.e. before caching
+        df = df.withColumn(file_column, input_file_name())
+
+    raw = None
+    if quarantine_path:
+        # Spark does not allow queries referencing only the corrupt record column of raw JSON data
+        df = raw = df.cache()
+        print(f"Writing malformed records to {quarantine_path}")
+        df.filter(col(CORRUPT_RECORD).isNotNull()).select(CORRUPT_RECORD).write.mode("append").text(quarantine_path)
+
+    return df.filter(col(CORRUPT_RECORD).isNull()).drop(CORRUPT_RECORD), raw
+
+
+def read_compacted(spark: SparkSession, compacted_data: str, dataset: str, schema: StructType,
+                   fmt: str = "parquet") -> DataFrame:
+    """
+    Read a dataset which has been compacted into few large files by compact.py.
+    :param spark: SparkSession
+    :param compacted_data: Path to compacted data
+    :param dataset: Name of dataset, i.e. song_data or log_data
+    :param schema: Schema of JSON records (only used for format json)
+    :param fmt: Format of compacted data, i.e. parquet or json
+    :return: DataFrame
+    """
+    data = f"{compacted_data}/{dataset}/data/*"
+
+    if fmt == "parquet":
+        return spark.read.parquet(data)
+
+    return read_json(spark, data, schema)[0]
+
+
+def get_fs(spark: SparkSession, path: str):
+    """
+    Return the Hadoop file system (HDFS, S3, local, ...) a path belongs to and the path as Hadoop Path object.
+    :param spark: SparkSession
+    :param path: Path or glob pattern
+    :return: Tuple of Hadoop FileSystem and Path
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()), hadoop_path
+
+
+def path_exists(spark: SparkSession, path: str) -> bool:
+    """
+    Check whether a path exists.
+    :param spark: SparkSession
+    :param path: Path
+    :return: True if path exists
+    """
+    fs, hadoop_path = get_fs(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def read_watermark(spark: SparkSession, output_data: str):
+    """
+    Read the ingestion watermark, i.e. the latest timestamp (in ms) of log data processed so far.
+    :param spark: SparkSession
+    :param output_data: Path to output data
+    :return: Watermark or None if no log data has been processed yet
+    """
+    if not path_exists(spark, f"{output_data}/_watermark"):
+        return None
+
+    return spark.read.json(f"{output_data}/_watermark").first().ts
+
+
+def write_watermark(spark: SparkSession, output_data: str, ts: int) -> None:
+    """
+    Store the ingestion watermark.
+    :param spark: SparkSession
+    :param output_data: Path to output data
+    :param ts: Latest timestamp (in ms) of processed log data
+    :return: None
+    """
+    spark.createDataFrame([(ts,)], ["ts"]).coalesce(1).write.json(f"{output_data}/_watermark", mode="overwrite")
+
+
+def month_start(ts: int) -> int:
+    """
+    Return the first millisecond (UTC) of the month a timestamp (in ms) belongs to.
+    :param ts: Timestamp in ms
+    :return: Timestamp in ms
+    """
+    dt = datetime.utcfromtimestamp(ts / 1000)
+    return int((datetime(dt.year, dt.month, 1) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def list_log_partitions(spark: SparkSession, input_data: str, since: int) -> list:
+    """
+    List the year/month directories of log data which contain data of the month of since or later.
+    :param spark: SparkSession
+    :param input_data: Path to input data
+    :param since: Timestamp in ms
+    :return: List of paths
+    """
+    since_dt = datetime.utcfromtimestamp(since / 1000)
+    fs, pattern = get_fs(spark, f"{input_data}/log_data/*/*")
+
+    paths = []
+    for status in fs.globStatus(pattern) or []:
+        path = status.getPath()
+        try:
+            year_month = (int(path.getParent().getName()), int(path.getName()))
+        except ValueError:
+            continue
+        if status.isDirectory() and year_month >= (since_dt.year, since_dt.month):
+            paths.append(f"{path}/")
+
+    return paths
+
+
+def get_layouts(config: configparser.ConfigParser) -> dict:
+    """
+    Return the output layout of each table, i.e. TABLE_LAYOUTS updated by options like SONGS_PARTITION_BY=year or
+    SONGPLAYS_MAX_RECORDS_PER_FILE=1000000 of the LAYOUT section of the config. List options are comma separated.
+    :param config: Config
+    :return: Dictionary mapping table names to layouts
+    """
+    layouts = {}
+    for table, defaults in TABLE_LAYOUTS.items():
+        layout = dict(defaults)
+        for key, default in defaults.items():
+            option = f"{table}_{key}".upper()
+            if not config.has_option("LAYOUT", option):
+                continue
+            if isinstance(default, list):
+                layout[key] = [c.strip() for c in config.get("LAYOUT", option).split(",") if c.strip()]
+            elif isinstance(default, bool):
+                layout[key] = config.getboolean("LAYOUT", option)
+            else:
+                layout[key] = config.getint("LAYOUT", option)
+        layouts[table] = layout
+
+    return layouts
+
+
+def count_files(spark: SparkSession, path: str) -> tuple:
+    """
+    Count the data files of a table, ignoring metadata like _SUCCESS or .crc files.
+    :param spark: SparkSession
+    :param path: Path of table
+    :return: Tuple of number of files and total size in bytes
+    """
+    fs, hadoop_path = get_fs(spark, path)
+    files, size = 0, 0
+    it = fs.listFiles(hadoop_path, True)
+    while it.hasNext():
+        status = it.next()
+        name = status.getPath().getName()
+        if not name.startswith(("_", ".")):
+            files += 1
+            size += status.getLen()
+
+    return files, size
+
+
+def write_table(spark: SparkSession, df: DataFrame, path: str, layout: dict = None, dynamic: bool = False) -> dict:
+    """
+    Write a DataFrame to Parquet according to a layout (c.f. DEFAULT_LAYOUT) and report the number of files and the
+    average file size of the table afterwards. Records are repartitioned by the partition columns first, so that each
+    partition is written by files_per_partition tasks instead of every task writing a small file to every partition.
+    If dynamic is True, only those partitions contained in df are replaced (dynamic partition overwrite) and all other
+    partitions are left untouched. This requires partition columns, since an unpartitioned table would be replaced
+    completely, c.f. replace_partitions.
+    :param spark: SparkSession
+    :param df: DataFrame
+    :param path: Path of table
+    :param layout: Layout, DEFAULT_LAYOUT if None
+    :param dynamic: If True, use dynamic partition overwrite
+    :return: Dictionary with number of files and size in bytes of the table
+    """
+    layout = dict(DEFAULT_LAYOUT, **(layout or {}))
+    partition_by = layout["partition_by"]
+
+    if dynamic and not partition_by:
+        raise ValueError(f"Dynamic partition overwrite of {path} requires partition columns")
+
+    if partition_by and layout["repartition"]:
+        if layout["files_per_partition"] > 1:
+            # salt partitions, otherwise all records of a large partition end up in the same task; the salt is
+            # derived from the record, so that recomputed tasks (e.g. after executor loss) assign records the same way
+            salt = abs_(hash_(*df.columns) % layout["files_per_partition"])
+            df = df.repartition(*partition_by, salt)
+        else:
+            df = df.repartition(*partition_by)
+
+    bucketed = bool(layout["bucket_by"] and layout["num_buckets"])
+    if bucketed and dynamic:
+        print(f"Bucketing is not supported for dynamic partition overwrite, writing {path} without buckets")
+        bucketed = False
+
+    if layout["sort_by"] and not bucketed:
+        df = df.sortWithinPartitions(*layout["sort_by"])
+
+    writer = df.write.mode("overwrite")
+    if partition_by:
+        writer = writer.partitionBy(partition_by)
+    if layout["max_records_per_file"]:
+        writer = writer.option("maxRecordsPerFile", layout["max_records_per_file"])
+    if dynamic:
+        writer = writer.option("partitionOverwriteMode", "dynamic")
+
+    if bucketed:
+        # buckets are only known to Spark via the catalog, so save as (external) table at path, which has to be empty
+        fs, hadoop_path = get_fs(spark, path)
+        if fs.exists(hadoop_path):
+            fs.delete(hadoop_path, True)
+        writer = writer.bucketBy(layout["num_buckets"], *layout["bucket_by"])
+        if layout["sort_by"]:
+            writer = writer.sortBy(*layout["sort_by"])
+        writer.format("parquet").option("path", path).saveAsTable(os.path.basename(path.rstrip("/")))
+    else:
+        writer.parquet(path)
+
+    files, size = count_files(spark, path)
+    print(f"{path} has {files} files, {size / max(files, 1) / 1024 ** 2:.1f} MB on average")
+    return {"files": files, "bytes": size}
+
+
+def merge_table(spark: SparkSession, df: DataFrame, path: str, keys: list, layout: dict = None) -> None:
+    """
+    Merge new records into an existing table instead of rewriting it from scratch: records of df which differ from
+    the table replace existing records with the same keys. For partitioned tables only partitions containing
+    changed records are rewritten (c.f. write_table).
+    :param spark: SparkSession
+    :param df: New records
+    :param path: Path of table
+    :param keys: Columns identifying a record
+    :param layout: Layout of table, c.f. DEFAULT_LAYOUT
+    :return: None
+    """
+    partition_by = (layout or {}).get("partition_by")
+
+    if not path_exists(spark, path):
+        write_table(spark, df, path, layout)
+        return
+
+    existing = spark.read.parquet(path).select(df.columns)
+    changed = df.subtract(existing)
+
+    if not changed.head(1):
+        print(f"No changes to merge into {path}")
+        return
+
+    # only consider existing records of affected partitions
+    if partition_by:
+        existing = existing.join(changed.select(partition_by).distinct(), partition_by, "left_semi")
+
+    # keep changed records over existing ones
+    window = Window.partitionBy(keys).orderBy(col("_priority").desc())
+    merged = changed.withColumn("_priority", lit(1)) \
+        .union(existing.withColumn("_priority", lit(0))) \
+        .withColumn("_rank", row_number().over(window)) \
+        .filter(col("_rank") == 1) \
+        .drop("_priority", "_rank")
+
+    # materialize merged records, since their source is about to be overwritten
+    merged = merged.localCheckpoint()
+
+    write_table(spark, merged, path, layout, dynamic=bool(partition_by))
+
+
+def replace_partitions(spark: SparkSession, df: DataFrame, path: str, keys: list, layout: dict = None) -> None:
+    """
+    Replace those partitions of a table which are contained in df (dynamic partition overwrite). Tables without
+    partition columns cannot be overwritten partially, so df is merged into them instead (c.f. merge_table).
+    :param spark: SparkSession
+    :param df: New records
+    :param path: Path of table
+    :param keys: Columns identifying a record, used for unpartitioned tables
+    :param layout: Layout of table, c.f. DEFAULT_LAYOUT
+    :return: None
+    """
+    if (layout or {}).get("partition_by"):
+        write_table(spark, df, path, layout, dynamic=True)
+    else:
+        merge_table(spark, df, path, keys, layout)
+
+
+def get_storage_level(name: str):
+    """
+    Look up a storage level by name, e.g. MEMORY_AND_DISK or MEMORY_ONLY.
+    :param name: Name of storage level, NONE or empty to disable caching
+    :return: StorageLevel or None
+    """
+    if not name or name.upper() == "NONE":
+        return None
+    return getattr(StorageLevel, name.upper())
+
+
+@contextmanager
+def timed(stage: str, timings: dict = None):
+    """
+    Measure the wall time of a block and add it to timings[stage]. If timings is a StageMetrics object, also collect
+    rows, bytes and partitions of the Spark jobs run within the block.
+    :param stage: Name of stage
+    :param timings: Dictionary mapping stages to seconds or StageMetrics, nothing is recorded if None
+    """
+    if isinstance(timings, StageMetrics):
+        with timings.stage(stage):
+            yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def process_song_data(spark: SparkSession, input_data: str, output_data: str, infer_schema: bool = False,
+                      quarantine_data: str = None, compacted_data: str = None,
+                      compacted_format: str = "parquet", incremental: bool = False, storage_level=None,
+                      timings: dict = None, layouts: dict = None) -> tuple:
     """
     Given an input path to song data, select relevant columns for songs and artist tables and save those to disk
-    respecting an output path.
+    respecting an output path. If a storage level is given, song data is read only once for both tables and the
+    tables are kept in memory, so that the log stage can use them without reading them back from disk.
     :param spark: SparkSession
     :param input_data: Path to input data
     :param output_data: Path to store output data
-    :return: None
+    :param infer_schema: If True, infer schema of song data instead of using song_schema
+    :param quarantine_data: Path to store malformed records
+    :param compacted_data: If given, read song data compacted by compact.py from this path instead of input_data
+    :param compacted_format: Format of compacted data, i.e. parquet or json
+    :param incremental: If True, merge songs and artists into existing tables instead of rewriting them
+    :param storage_level: StorageLevel to persist song data and tables at, None to disable caching
+    :param timings: Dictionary to record wall time per stage in, c.f. timed
+    :param layouts: Output layout per table, TABLE_LAYOUTS if None
+    :return: Tuple of persisted songs and artists tables, (None, None) if not cached or incremental
     """
+    layouts = layouts or TABLE_LAYOUTS
+
     # get filepath to song data file
     song_data = f"{input_data}/song_data/*/*/*"
 
     # read song data file
+    # reading is lazy, so the stage is only recorded if song data is persisted, i.e. read completely within it
     print("Loading song data")
-    df = spark.read.format("json").load(song_data)
+    raw = None
+    with timed("read_song_data", timings if storage_level is not None else None):
+        if compacted_data:
+            df = read_compacted(spark, compacted_data, "song_data", song_schema, compacted_format)
+        else:
+            df, raw = read_json(spark, song_data, song_schema, infer_schema,
+                                f"{quarantine_data}/song_data" if quarantine_data else None)
+
+        # song data is used for both tables
+        if storage_level is not None:
+            df = df.persist(storage_level)
+            print(f"Read {df.count()} song records")
+
+    # only the complete tables are worth keeping for the log stage
+    cache = storage_level is not None and not incremental
 
     # extract columns to create songs table
     songs_table = df.dropDuplicates(["song_id"]).select(["song_id", "title", "artist_id", "year", "duration"])
+    if cache:
+        songs_table = songs_table.persist(storage_level)
 
-    # write songs table to parquet files partitioned by year and artist
+    # write songs table to parquet files (partitioned by year and artist by default)
     print("Writing songs table")
-    songs_table.write.partitionBy(["year", "artist_id"]).parquet(f"{output_data}/songs/", mode="overwrite")
+    with timed("songs", timings):
+        if incremental:
+            merge_table(spark, songs_table, f"{output_data}/songs/", ["song_id"], layouts["songs"])
+        else:
+            write_table(spark, songs_table, f"{output_data}/songs/", layouts["songs"])
 
     # extract columns to create artists table
     artists_table = df.dropDuplicates(["artist_id"]).select(["artist_id", "artist_name", "artist_location",
                                                              "artist_latitude", "artist_longitude"])
+    if cache:
+        artists_table = artists_table.persist(storage_level)
 
     # write artists table to parquet files
     print("Writing artists table")
-    artists_table.write.parquet(f"{output_data}/artists/", mode="overwrite")
+    with timed("artists", timings):
+        if incremental:
+            merge_table(spark, artists_table, f"{output_data}/artists/", ["artist_id"], layouts["artists"])
+        else:
+            write_table(spark, artists_table, f"{output_data}/artists/", layouts["artists"])
+
+    if storage_level is not None:
+        df.unpersist()
+    if raw is not None:
+        raw.unpersist()
     print("Finished processing song data")
 
+    return (songs_table, artists_table) if cache else (None, None)
+
+
+def normalize(column: str):
+    """
+    Normalize a string column for joining, i.e. trim whitespace and convert to lower case.
+    :param column: Name of column
+    :return: Column
+    """
+    return lower(trim(col(column)))
+
+
+def build_song_dimension(songs_table: DataFrame, artists_table: DataFrame, precision: int = 2) -> DataFrame:
+    """
+    Build the lookup dimension resolving song plays to song_id and artist_id, keyed on normalized title, normalized
+    artist name and duration rounded to precision decimals. Keys are unique, so joining does not multiply events.
+    :param songs_table: Songs table
+    :param artists_table: Artists table
+    :param precision: Number of decimals durations are rounded to
+    :return: DataFrame with columns title_key, artist_key, duration_key, song_id, artist_id and artist_location
+    """
+    return songs_table.join(artists_table, "artist_id", "inner") \
+        .select(normalize("title").alias("title_key"),
+                normalize("artist_name").alias("artist_key"),
+                round_(col("duration"), precision).alias("duration_key"),
+                "song_id", "artist_id", "artist_location") \
+        .dropDuplicates(["title_key", "artist_key", "duration_key"])
 
-def process_log_data(spark: SparkSession, input_data: str, output_data: str) -> None:
+
+def estimate_size(df: DataFrame) -> int:
+    """
+    Return the size of a DataFrame in bytes as estimated by Spark's optimizer, without running a job. This is the size
+    in memory for cached and the size on disk for Parquet data, but meaningless for joins.
+    :param df: DataFrame
+    :return: Estimated size in bytes
+    """
+    return int(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+
+
+def join_song_dimension(df: DataFrame, song_dim: DataFrame, size: int = None, precision: int = 2,
+                        broadcast_threshold: int = 64 * 1024 ** 2) -> DataFrame:
+    """
+    Join song plays with the song dimension on normalized keys. If the dimension's estimated size is below
+    broadcast_threshold it is broadcast to all executors, so that the (large and possibly skewed) log data is not
+    shuffled at all. Otherwise Spark falls back to a shuffle (sort-merge) join. Without cost based optimization,
+    Spark estimates the size of a join as the product of the sizes of its sides, so the size of the dimension has
+    to be estimated from the songs table it is built from: it has at most one row per song.
+    :param df: Song plays
+    :param song_dim: Song dimension as returned by build_song_dimension
+    :param size: Estimated size of the dimension in bytes, e.g. that of the songs table, None to let Spark decide
+    :param precision: Number of decimals durations are rounded to, has to match build_song_dimension
+    :param broadcast_threshold: Maximum size of the dimension in bytes to broadcast it
+    :return: Joined DataFrame
+    """
+    keys = ["title_key", "artist_key", "duration_key"]
+    df = df \
+        .withColumn("title_key", normalize("song")) \
+        .withColumn("artist_key", normalize("artist")) \
+        .withColumn("duration_key", round_(col("length"), precision))
+
+    if size is None:
+        return df.join(song_dim, keys, "inner").drop(*keys)
+
+    if size <= broadcast_threshold:
+        print(f"Broadcasting song dimension (~{size / 1024 ** 2:.1f} MB)")
+        return df.join(broadcast(song_dim), keys, "inner").drop(*keys)
+
+    print(f"Song dimension too large to broadcast (~{size / 1024 ** 2:.1f} MB), using sort-merge join")
+    return df.join(song_dim, keys, "inner").drop(*keys)
+
+
+def process_log_data(spark: SparkSession, input_data: str, output_data: str, infer_schema: bool = False,
+                     quarantine_data: str = None, compacted_data: str = None,
+                     compacted_format: str = "parquet", incremental: bool = False, songs_table: DataFrame = None,
+                     artists_table: DataFrame = None, storage_level=None, timings: dict = None,
+                     layouts: dict = None) -> None:
     """
     Given an input path to log data, select relevant columns for user and time tables and save those to disk
-    respecting an output path. Then load previously processed song and artist data, join it with log data, create
-    the songplay table and write it to disk.
+    respecting an output path. Then load previously processed song and artist data (unless passed in by the song
+    stage), join it with log data, create the songplay table and write it to disk.
     :param spark: SparkSession
     :param input_data: Path to input data
     :param output_data: Path to store output data
+    :param infer_schema: If True, infer schema of log data instead of using log_schema
+    :param quarantine_data: Path to store malformed records
+    :param compacted_data: If given, read log data compacted by compact.py from this path instead of input_data
+    :param compacted_format: Format of compacted data, i.e. parquet or json
+    :param incremental: If True, only process months of log data at or after the ingestion watermark, replace the
+    corresponding year/month partitions of time and songplays tables and merge users into the existing table
+    :param songs_table: Songs table as returned by process_song_data, read from output_data if None
+    :param artists_table: Artists table as returned by process_song_data, read from output_data if None
+    :param storage_level: StorageLevel to persist filtered log data at, None to disable caching
+    :param timings: Dictionary to record wall time per stage in, c.f. timed
+    :param layouts: Output layout per table, TABLE_LAYOUTS if None
     :return: None
     """
+    layouts = layouts or TABLE_LAYOUTS
+
     # get filepath to log data file
     log_data = f"{input_data}/log_data/*/*/"
 
-    # read log data file
-    print("Loading log data")
-    df = spark.read.json(log_data)
+    # in incremental mode, (re)process complete months starting with the month of the watermark
+    since = None
+    if incremental:
+        watermark = read_watermark(spark, output_data)
+        since = month_start(watermark) if watermark is not None else None
+        print(f"Processing log data since {since if since is not None else 'the beginning'}")
 
-    # filter by actions for song plays
-    df = df.filter(df.page == "NextSong")
+    if since is not None and not compacted_data:
+        log_data = list_log_partitions(spark, input_data, since)
+        if not log_data:
+            print("No new log data")
+            return
+
+    # read log data file, like song data the stage is only recorded if log data is persisted
+    print("Loading log data")
+    raw = None
+    with timed("read_log_data", timings if storage_level is not None else None):
+        if compacted_data:
+            df = read_compacted(spark, compacted_data, "log_data", log_schema, compacted_format)
+        else:
+            df, raw = read_json(spark, log_data, log_schema, infer_schema,
+                                f"{quarantine_data}/log_data" if quarantine_data else None)
+
+        if since is not None:
+            df = df.filter(df.ts >= since)
+
+        # filter by actions for song plays, the result is used for users, time and songplays tables
+        df = df.filter(df.page == "NextSong")
+        if storage_level is not None:
+            df = df.persist(storage_level)
+            print(f"Read {df.count()} song plays")
+    cached = df
 
     # extract columns for users table
     user_table = df.dropDuplicates(["userId"]).select(["userId", "firstName", "lastName", "gender", "level"])
 
     # write users table to parquet files
     print("Writing user table")
-    user_table.write.parquet(f"{output_data}/users/", mode="overwrite")
+    with timed("users", timings):
+        if incremental:
+            merge_table(spark, user_table, f"{output_data}/users/", ["userId"], layouts["users"])
+        else:
+            write_table(spark, user_table, f"{output_data}/users/", layouts["users"])
+
+    # remember latest timestamp before it is converted
+    max_ts = df.agg(max_("ts")).first()[0] if incremental else None
 
     # create timestamp column from original timestamp column
     df = df.withColumn("ts", from_unixtime(df.ts / 1000))
@@ -93,38 +671,118 @@ def process_log_data(spark: SparkSession, input_data: str, output_data: str) ->
                                                    year(df.ts).alias("year"),
                                                    dayofweek(df.ts).alias("weekday")])
 
-    # write time table to parquet files partitioned by year and month
+    # write time table to parquet files (partitioned by year and month by default)
     print("Writing time table")
-    time_table.write.partitionBy(["year", "month"]).parquet(f"{output_data}/time/", mode="overwrite")
+    with timed("time", timings):
+        if incremental:
+            replace_partitions(spark, time_table, f"{output_data}/time/", ["ts"], layouts["time"])
+        else:
+            write_table(spark, time_table, f"{output_data}/time/", layouts["time"])
 
     # read in song and artist data required for songplays table
-    print("Loading song data")
-    songs_table = spark.read.parquet(f"{output_data}/songs/")
+    if songs_table is None:
+        print("Loading song data")
+        songs_table = spark.read.parquet(f"{output_data}/songs/")
 
-    print("Loading artist data")
-    artists_table = spark.read.parquet(f"{output_data}/artists/")
+    if artists_table is None:
+        print("Loading artist data")
+        artists_table = spark.read.parquet(f"{output_data}/artists/")
 
     # join datasets
     print("Joining song, artist and log data")
-    join_cond = [df.song == songs_table.title, df.artist == artists_table.artist_name,
-                 df.length == songs_table.duration]
+    song_dim = build_song_dimension(songs_table, artists_table)
+    joined_df = join_song_dimension(df, song_dim, estimate_size(songs_table))
 
-    joined_df = songs_table.join(artists_table, "artist_id", "inner").join(df, join_cond, "inner")
-
-    # extract columns from joined song and log datasets to create songplays table
+    # extract columns from joined song and log datasets to create songplays table, the id is derived from the event
+    # (like playid of the Airflow pipeline), so that it is stable across incremental runs replacing partitions
     songplays_table = joined_df \
-        .withColumn("songplay_id", monotonically_increasing_id()) \
+        .withColumn("songplay_id", md5(concat_ws("|", "sessionId", "ts", "userId", "itemInSession"))) \
         .withColumn("year", year(df.ts).alias("year")) \
         .withColumn("month", month(df.ts).alias("month")) \
         .select(["songplay_id", "ts", "userId", "level", "song_id", "artist_id", "sessionId",
                  "artist_location", "userAgent", "year", "month"])
 
-    # write songplays table to parquet files partitioned by year and month
+    # write songplays table to parquet files (partitioned by year and month by default)
     print("Writing songplay table")
-    songplays_table.write.partitionBy(["year", "month"]).parquet(f"{output_data}/songplays/", mode="overwrite")
+    with timed("songplays", timings):
+        if incremental:
+            replace_partitions(spark, songplays_table, f"{output_data}/songplays/", ["songplay_id"],
+                               layouts["songplays"])
+        else:
+            write_table(spark, songplays_table, f"{output_data}/songplays/", layouts["songplays"])
+        if incremental and max_ts is not None:
+            write_watermark(spark, output_data, max_ts)
+
+    if storage_level is not None:
+        cached.unpersist()
+    if raw is not None:
+        raw.unpersist()
     print("Finished processing log data")
 
 
+def run_etl(spark: SparkSession, input_data: str, output_data: str, infer_schema: bool = False,
+            quarantine_data: str = None, compacted_data: str = None, compacted_format: str = "parquet",
+            incremental: bool = False, storage_level=None, layouts: dict = None,
+            metrics: StageMetrics = None) -> dict:
+    """
+    Run song and log stages. If a storage level is given, intermediates shared between writes are persisted and the
+    songs and artists tables are passed from the song stage to the log stage instead of being read back from disk.
+    Everything persisted is released at the end.
+    :param spark: SparkSession
+    :param input_data: Path to input data
+    :param output_data: Path to store output data
+    :param infer_schema: If True, infer schemas instead of using song_schema and log_schema
+    :param quarantine_data: Path to store malformed records
+    :param compacted_data: If given, read data compacted by compact.py from this path instead of input_data
+    :param compacted_format: Format of compacted data, i.e. parquet or json
+    :param incremental: If True, process new data only, c.f. process_song_data and process_log_data
+    :param storage_level: StorageLevel to persist intermediates at, None to disable caching
+    :param layouts: Output layout per table, TABLE_LAYOUTS if None
+    :param metrics: StageMetrics to collect detailed metrics per stage in
+    :return: Dictionary mapping stages to wall time in seconds, i.e. metrics if given
+    """
+    timings = metrics if metrics is not None else {}
+
+    print("Start processing song data")
+    songs_table, artists_table = process_song_data(spark, input_data, output_data, infer_schema, quarantine_data,
+                                                   compacted_data, compacted_format, incremental, storage_level,
+                                                   timings, layouts)
+    try:
+        print("Start processing log data")
+        process_log_data(spark, input_data, output_data, infer_schema, quarantine_data, compacted_data,
+                         compacted_format, incremental, songs_table, artists_table, storage_level, timings,
+                         layouts)
+    finally:
+        for table in (songs_table, artists_table):
+            if table is not None:
+                table.unpersist()
+
+    return timings
+
+
+def print_report(timings: dict, baseline_path: str = None) -> None:
+    """
+    Print wall time per stage. If the report of a previous run is given, e.g. one with STORAGE_LEVEL=NONE, also
+    print the time saved per stage compared to it.
+    :param timings: Dictionary mapping stages to seconds
+    :param baseline_path: Path to JSON report of a previous run
+    :return: None
+    """
+    baseline = {}
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    print(f"{'stage':<12}{'time':>10}{'saved':>10}")
+    for stage, seconds in list(timings.items()) + [("total", sum(timings.values()))]:
+        if stage == "total":
+            before = sum(baseline.values()) if baseline else None
+        else:
+            before = baseline.get(stage)
+        saved = f"{before - seconds:>9.1f}s" if before is not None else f"{'-':>10}"
+        print(f"{stage:<12}{seconds:>9.1f}s{saved}")
+
+
 def main():
     # load config
     config = configparser.ConfigParser()
@@ -141,6 +799,18 @@ def main():
     # define input/output paths for loading/writing data
     input_data = config.get("ETL", "INPUT_DATA")
     output_data = config.get("ETL", "OUTPUT_DATA")
+    quarantine_data = config.get("ETL", "QUARANTINE_DATA", fallback=None) or None
+    infer_schema = config.getboolean("ETL", "INFER_SCHEMA", fallback=False)
+    compacted_data = config.get("ETL", "COMPACTED_DATA") if config.getboolean("ETL", "READ_COMPACTED",
+                                                                               fallback=False) else None
+    compacted_format = config.get("ETL", "COMPACTED_FORMAT", fallback="parquet")
+    incremental = config.getboolean("ETL", "INCREMENTAL", fallback=False)
+    storage_level = get_storage_level(config.get("ETL", "STORAGE_LEVEL", fallback="MEMORY_AND_DISK"))
+    run_report = config.get("ETL", "RUN_REPORT", fallback=None) or None
+    baseline_report = config.get("ETL", "BASELINE_REPORT", fallback=None) or None
+    layouts = get_layouts(config)
+    metrics_log = config.get("ETL", "METRICS_LOG", fallback=None) or None
+    prometheus_textfile = config.get("ETL", "PROMETHEUS_TEXTFILE", fallback=None) or None
 
     # create spark session
     print("Start pipeline")
@@ -148,13 +818,20 @@ def main():
     spark = create_spark_session(config.get("EMR", "SPARK_JARS"))
 
     # process data
-    print("Start processing song data")
-    process_song_data(spark, input_data, output_data)
-
-    print("Start processing log data")
-    process_log_data(spark, input_data, output_data)
+    metrics = StageMetrics(spark)
+    timings = run_etl(spark, input_data, output_data, infer_schema, quarantine_data, compacted_data,
+                      compacted_format, incremental, storage_level, layouts, metrics)
 
     print("Finished pipeline")
+    metrics.print_summary()
+    print_report(timings, baseline_report)
+    if run_report:
+        with open(run_report, "w") as f:
+            json.dump(timings, f, indent=2)
+    if metrics_log:
+        metrics.write_json(metrics_log)
+    if prometheus_textfile:
+        metrics.write_prometheus(prometheus_textfile)
 
 
 if __name__ == "__main__":
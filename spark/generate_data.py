@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import random
+import string
+from datetime import datetime, timedelta
+
+
+FIRST_NAMES = ["Lily", "Jacob", "Kate", "Chloe", "Tegan", "Aleena", "Jayden", "Matthew", "Sara", "Ryan"]
+LAST_NAMES = ["Koch", "Klein", "Harrell", "Cuevas", "Levine", "Kirby", "Graves", "Jones", "Johnson", "Smith"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Lansing-East Lansing, MI", "Chicago-Naperville-Elgin, IL-IN-WI",
+             "Atlanta-Sandy Springs-Roswell, GA", "Portland-South Portland, ME",
+             "New York-Newark-Jersey City, NY-NJ-PA"]
+USER_AGENTS = ["Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0 Safari/537.36",
+               "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Safari/537.78",
+               "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0"]
+WORDS = ["Love", "Night", "Fire", "Blue", "Dream", "Heart", "Road", "Rain", "Gold", "Shadow", "Sun", "River"]
+
+
+def random_id(rng: random.Random, prefix: str) -> str:
+    """
+    Generate an ID like those of the Million Song Dataset, e.g. TRAAAAW128F429D538.
+    :param rng: Random number generator
+    :param prefix: Prefix, i.e. TR for tracks, SO for songs and AR for artists
+    :return: ID
+    """
+    return prefix + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+
+def make_songs(rng: random.Random, num_songs: int, num_artists: int) -> list:
+    """
+    Generate song records as contained in song_data.
+    :param rng: Random number generator
+    :param num_songs: Number of songs
+    :param num_artists: Number of artists
+    :return: List of dictionaries
+    """
+    artists = [{
+        "artist_id": random_id(rng, "AR"),
+        "artist_name": f"{rng.choice(WORDS)} {rng.choice(WORDS)}s",
+        "artist_location": rng.choice(LOCATIONS + [""]),
+        "artist_latitude": round(rng.uniform(-90, 90), 5) if rng.random() < 0.4 else None,
+        "artist_longitude": round(rng.uniform(-180, 180), 5) if rng.random() < 0.4 else None
+    } for _ in range(num_artists)]
+
+    songs = []
+    for _ in range(num_songs):
+        song = dict(rng.choice(artists))
+        song.update({
+            "num_songs": 1,
+            "song_id": random_id(rng, "SO"),
+            "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+            "duration": round(rng.uniform(60, 600), 5),
+            "year": rng.choice([0] + list(range(1960, 2019)))
+        })
+        songs.append(song)
+
+    return songs
+
+
+def write_songs(songs: list, output_path: str, rng: random.Random) -> None:
+    """
+    Write one JSON file per song to song_data/<A>/<B>/<C>/<track id>.json like the original dataset.
+    :param songs: List of song records
+    :param output_path: Path to write data to
+    :param rng: Random number generator
+    :return: None
+    """
+    for song in songs:
+        track_id = random_id(rng, "TR")
+        directory = os.path.join(output_path, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{track_id}.json"), "w") as f:
+            json.dump(song, f)
+
+
+def write_events(songs: list, num_events: int, num_users: int, output_path: str, rng: random.Random,
+                 start: datetime = datetime(2018, 11, 1), match_rate: float = 0.5) -> None:
+    """
+    Write num_events log events to one line-delimited JSON file per day, i.e.
+    log_data/<year>/<month>/<year>-<month>-<day>-events.json. Events are spread over sessions of random users,
+    about 80% are song plays of which match_rate refer to generated songs.
+    :param songs: List of song records
+    :param num_events: Number of events
+    :param num_users: Number of users
+    :param output_path: Path to write data to
+    :param rng: Random number generator
+    :param start: Timestamp of the first event
+    :param match_rate: Fraction of song plays referring to generated songs
+    :return: None
+    """
+    users = [{
+        "userId": str(user_id),
+        "firstName": rng.choice(FIRST_NAMES),
+        "lastName": rng.choice(LAST_NAMES),
+        "gender": rng.choice(["F", "M"]),
+        "level": rng.choice(["free", "paid"]),
+        "location": rng.choice(LOCATIONS),
+        "userAgent": rng.choice(USER_AGENTS),
+        "registration": float(rng.randint(1530000000000, 1541000000000))
+    } for user_id in range(1, num_users + 1)]
+
+    # spread events over 30 days, so that time and songplays tables get several partitions
+    step = timedelta(days=30) / max(num_events, 1)
+    ts = start
+    files = {}
+    session_id, item = 0, 0
+    user = users[0]
+
+    try:
+        for i in range(num_events):
+            if i == 0 or rng.random() < 0.05:
+                session_id, item, user = session_id + 1, 0, rng.choice(users)
+
+            event = dict(user, auth="Logged In", itemInSession=item, sessionId=session_id, method="PUT", status=200,
+                         ts=int((ts - datetime(1970, 1, 1)).total_seconds() * 1000),
+                         artist=None, song=None, length=None)
+            if rng.random() < 0.8:
+                if rng.random() < match_rate:
+                    song = rng.choice(songs)
+                    event.update(artist=song["artist_name"], song=song["title"], length=song["duration"])
+                else:
+                    event.update(artist=f"{rng.choice(WORDS)} {rng.choice(WORDS)}", song=rng.choice(WORDS),
+                                 length=round(rng.uniform(60, 600), 5))
+                event["page"] = "NextSong"
+            else:
+                event.update(page=rng.choice(["Home", "Logout", "Settings"]), method="GET")
+
+            day = ts.strftime("%Y-%m-%d")
+            if day not in files:
+                directory = os.path.join(output_path, "log_data", ts.strftime("%Y"), ts.strftime("%m"))
+                os.makedirs(directory, exist_ok=True)
+                files[day] = open(os.path.join(directory, f"{day}-events.json"), "w")
+            files[day].write(json.dumps(event) + "\n")
+
+            ts += step
+            item += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def generate(output_path: str, num_events: int, num_songs: int = None, num_artists: int = None,
+             num_users: int = None, seed: int = 42) -> None:
+    """
+    Generate synthetic Sparkify song and log data with the layout of the original datasets.
+    :param output_path: Path to write data to
+    :param num_events: Number of log events
+    :param num_songs: Number of songs, defaults to 1% of events
+    :param num_artists: Number of artists, defaults to a third of the songs
+    :param num_users: Number of users, defaults to 0.1% of events
+    :param seed: Random seed
+    :return: None
+    """
+    rng = random.Random(seed)
+    num_songs = num_songs or max(10, num_events // 100)
+    num_artists = num_artists or max(1, num_songs // 3)
+    num_users = num_users or max(10, num_events // 1000)
+
+    print(f"Generating {num_songs} songs of {num_artists} artists")
+    songs = make_songs(rng, num_songs, num_artists)
+    write_songs(songs, output_path, rng)
+
+    print(f"Generating {num_events} events of {num_users} users")
+    write_events(songs, num_events, num_users, output_path, rng)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song and log data")
+    parser.add_argument("--output", default="data/synthetic", help="path to write data to")
+    parser.add_argument("--events", type=int, default=10000, help="number of log events, e.g. 1000 to 10000000")
+    parser.add_argument("--songs", type=int, default=None, help="number of songs, defaults to 1%% of events")
+    parser.add_argument("--users", type=int, default=None, help="number of users, defaults to 0.1%% of events")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    generate(args.output, args.events, args.songs, num_users=args.users, seed=args.seed)
+    print("Finished generating data")
+
+
+if __name__ == "__main__":
+    main()
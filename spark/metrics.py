@@ -0,0 +1,151 @@
+import json
+import os
+import time
+import urllib.request
+from contextlib import contextmanager
+from pyspark.sql import SparkSession
+
+
+# metrics of Spark stages summed up per ETL stage, c.f. REST API of the Spark UI
+SPARK_METRICS = {
+    "inputRecords": "input_rows",
+    "inputBytes": "input_bytes",
+    "outputRecords": "output_rows",
+    "outputBytes": "output_bytes",
+    "shuffleReadBytes": "shuffle_read_bytes",
+    "shuffleWriteBytes": "shuffle_write_bytes",
+    "numTasks": "tasks"
+}
+
+
+class StageMetrics(dict):
+    """
+    Collect metrics of ETL stages, i.e. wall time, input/output rows and bytes, shuffle bytes and partitions.
+    All Spark jobs run within a stage are tagged with a job group, whose metrics are read from the REST API of the
+    Spark UI afterwards. Behaves like a dictionary mapping stage names to wall time in seconds, detailed metrics
+    of each stage are kept in records.
+    """
+
+    def __init__(self, spark: SparkSession, run_id: str = None, timeout: float = 10.0):
+        """
+        :param spark: SparkSession
+        :param run_id: ID of the run, defaults to the current time
+        :param timeout: Seconds to wait for the Spark UI to catch up with finished jobs
+        """
+        super().__init__()
+        self.spark = spark
+        self.run_id = run_id or time.strftime("%Y%m%dT%H%M%S")
+        self.timeout = timeout
+        self.records = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure an ETL stage, i.e. all Spark jobs run within the block.
+        :param name: Name of stage
+        """
+        sc = self.spark.sparkContext
+        group = f"{self.run_id}-{len(self.records)}-{name}"
+        previous = sc.getLocalProperty("spark.jobGroup.id"), sc.getLocalProperty("spark.job.description")
+        sc.setJobGroup(group, name)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            sc.setLocalProperty("spark.jobGroup.id", previous[0])
+            sc.setLocalProperty("spark.job.description", previous[1])
+
+            self[name] = self.get(name, 0.0) + seconds
+            record = {"run_id": self.run_id, "stage": name, "seconds": seconds,
+                      "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            record.update(self.collect(group))
+            self.records.append(record)
+
+    def get_json(self, endpoint: str) -> list:
+        """
+        Query the REST API of the Spark UI.
+        :param endpoint: Endpoint relative to the application, e.g. jobs
+        :return: Parsed response
+        """
+        sc = self.spark.sparkContext
+        with urllib.request.urlopen(f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/{endpoint}") as response:
+            return json.load(response)
+
+    def collect(self, group: str) -> dict:
+        """
+        Sum up the metrics of all Spark stages of the jobs of a job group. The Spark UI is updated asynchronously,
+        so wait until it knows all jobs of the group as finished.
+        :param group: Job group
+        :return: Dictionary of metrics, c.f. SPARK_METRICS, empty if the Spark UI is disabled
+        """
+        if not self.spark.sparkContext.uiWebUrl:
+            return {}
+
+        job_ids = set(self.spark.sparkContext.statusTracker().getJobIdsForGroup(group))
+        deadline = time.time() + self.timeout
+        while True:
+            jobs = [job for job in self.get_json("jobs") if job["jobId"] in job_ids]
+            if (len(jobs) == len(job_ids) and all(job["status"] != "RUNNING" for job in jobs)) \
+                    or time.time() > deadline:
+                break
+            time.sleep(0.2)
+
+        stage_ids = {stage_id for job in jobs for stage_id in job["stageIds"]}
+        stages = [stage for stage in self.get_json("stages")
+                  if stage["stageId"] in stage_ids and stage["status"] == "COMPLETE"]
+
+        metrics = {name: sum(stage[key] for stage in stages) for key, name in SPARK_METRICS.items()}
+        metrics["jobs"] = len(jobs)
+        # the last stage writes the output, its number of tasks is the number of output partitions
+        metrics["output_partitions"] = max(stages, key=lambda stage: stage["stageId"])["numTasks"] if stages else 0
+
+        return metrics
+
+    def print_summary(self) -> None:
+        """
+        Print wall time, rows, bytes and throughput of each stage.
+        :return: None
+        """
+        print(f"{'stage':<16}{'time':>9}{'rows in':>12}{'rows out':>12}{'MB in':>9}{'MB out':>9}{'rows/s':>11}")
+        for record in self.records:
+            rows = max(record.get("input_rows", 0), record.get("output_rows", 0))
+            print(f"{record['stage']:<16}{record['seconds']:>8.1f}s"
+                  f"{record.get('input_rows', 0):>12}{record.get('output_rows', 0):>12}"
+                  f"{record.get('input_bytes', 0) / 1024 ** 2:>9.1f}{record.get('output_bytes', 0) / 1024 ** 2:>9.1f}"
+                  f"{rows / max(record['seconds'], 1e-9):>11.0f}")
+
+    def write_json(self, path: str) -> None:
+        """
+        Append one JSON line per stage to a log file.
+        :param path: Path of log file
+        :return: None
+        """
+        with open(path, "a") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, path: str, prefix: str = "sparkify_etl") -> None:
+        """
+        Write the metrics of the last run of each stage in Prometheus text format, e.g. for the textfile collector of
+        node_exporter. The file is replaced atomically, so that it is never scraped half written.
+        :param path: Path of textfile, has to end with .prom for the textfile collector
+        :param prefix: Prefix of metric names
+        :return: None
+        """
+        latest = {record["stage"]: record for record in self.records}
+        names = ["seconds", "jobs", "output_partitions"] + list(SPARK_METRICS.values())
+
+        lines = []
+        for name in names:
+            lines.append(f"# TYPE {prefix}_stage_{name} gauge")
+            for stage, record in latest.items():
+                if name in record:
+                    lines.append(f'{prefix}_stage_{name}{{stage="{stage}"}} {record[name]}')
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {time.time():.0f}")
+
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)